@@ -27,11 +27,9 @@ def generate_api_key(length: int = 64) -> str:
     Returns:
         A hexadecimal string of the specified length
     """
-    # Generate random bytes and convert to hex
     # Each byte produces 2 hex characters, so we need length/2 bytes
     num_bytes = length // 2
-    random_bytes = secrets.token_bytes(num_bytes)
-    api_key = random_bytes.hex()
+    api_key = secrets.token_hex(num_bytes)
     
     # If length is odd, truncate to exact length
     return api_key[:length]
@@ -74,13 +72,13 @@ Examples:
     
     print(f"Generating {args.count} API key(s) of length {args.length}:\n")
     
-    for i in range(args.count):
-        key = generate_api_key(args.length)
+    keys = [generate_api_key(args.length) for _ in range(args.count)]
+    for i, key in enumerate(keys):
         print(f"API Key {i+1}: {key}")
     
     print("\n" + "="*70)
     print("To use this key, add it to your .env file:")
-    print(f"API_KEY={generate_api_key(args.length) if args.count == 1 else '<your_key_here>'}")
+    print(f"API_KEY={keys[0] if args.count == 1 else '<your_key_here>'}")
     print("\nOr set it as an environment variable:")
     print(f"export API_KEY=<your_key_here>")
 
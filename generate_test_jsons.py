@@ -1,8 +1,9 @@
 import argparse
-import json
 import random
 import sys
 
+import orjson
+
 def distribute_ids_to_doctors(file_path: str, num_doctors: int, refresh: bool = False, doctor_id_range: tuple = (1000, 9999)) -> str:
     """Distributes patient IDs from a text file among a specified number of doctors.
 
@@ -17,21 +18,19 @@ def distribute_ids_to_doctors(file_path: str, num_doctors: int, refresh: bool =
     """
     if num_doctors <= 0:
         print("Error: num_doctors must be a positive integer.", file=sys.stderr)
-        return json.dumps({})
+        return orjson.dumps({}).decode()
 
-    patient_ids = []
     try:
+        # One read of the whole file, then C-level line splitting and stripping
         with open(file_path, 'r') as f:
-            for line in f:
-                stripped_line = line.strip()
-                if stripped_line:
-                    patient_ids.append(stripped_line)
+            raw = f.read()
+        patient_ids = [patient_id for patient_id in map(str.strip, raw.splitlines()) if patient_id]
     except FileNotFoundError:
         print(f"Error: The file '{file_path}' was not found.", file=sys.stderr)
-        return json.dumps({})
+        return orjson.dumps({}).decode()
     except Exception as e:
         print(f"An error occurred while reading the file: {e}", file=sys.stderr)
-        return json.dumps({})
+        return orjson.dumps({}).decode()
 
     if not patient_ids and num_doctors > 0:
         print("Warning: No patient IDs found in the file. Generating requests with empty patient lists.", file=sys.stderr)
@@ -43,27 +42,21 @@ def distribute_ids_to_doctors(file_path: str, num_doctors: int, refresh: bool =
         generated_doctor_ids = random.sample(range(doctor_id_range[0], doctor_id_range[1] + 1), num_doctors)
 
 
-    doctor_assignments = {doc_id: [] for doc_id in generated_doctor_ids}
-
-    if patient_ids:
-        for i, patient_id in enumerate(patient_ids):
-            doctor_id_index = i % num_doctors
-            assigned_doctor_id = generated_doctor_ids[doctor_id_index]
-            doctor_assignments[assigned_doctor_id].append(patient_id)
+    # Round-robin assignment: doctor i gets every n-th patient starting at i
+    num_buckets = len(generated_doctor_ids)
+    buckets = [patient_ids[i::num_buckets] for i in range(num_buckets)]
 
-    requests_array = []
-    for doc_id in generated_doctor_ids:
-        requests_array.append({
-            "doctor_id": doc_id,
-            "patient_ids": doctor_assignments[doc_id]
-        })
+    requests_array = [
+        {"doctor_id": doc_id, "patient_ids": bucket}
+        for doc_id, bucket in zip(generated_doctor_ids, buckets)
+    ]
 
     json_body = {
         "requests": requests_array,
         "refresh": refresh
     }
 
-    return json.dumps(json_body, indent=2)
+    return orjson.dumps(json_body, option=orjson.OPT_INDENT_2).decode()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Distribute patient IDs from a text file among doctors and generate a JSON output.")
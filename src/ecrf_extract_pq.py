@@ -1,34 +1,71 @@
 import sys
 import os
 import logging
+import asyncio
+import time
+import httpx
 import pandas as pd
 import requests
-import json
+import orjson
 import numpy as np
+import polars as pl
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 import tempfile
-import shutil
 import argparse
 
+try:
+    import uvloop
+except ImportError:  # uvloop is optional (not available on Windows); fall back to the default event loop
+    uvloop = None
+
+try:
+    import redis
+except ImportError:  # Redis is optional; the token cache then lives in process memory only
+    redis = None
+
 load_dotenv(override=True)
 
 wd = os.getcwd()
 
+# Retry policy for patient fetches (mirrors the login session's urllib3 Retry)
+FETCH_RETRIES = 3
+FETCH_BACKOFF_FACTOR = 1
+FETCH_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# eCRF auth tokens are cached per email (in memory, and in Redis when REDIS_URL is set)
+# so exporters created for successive jobs skip the login round-trip
+TOKEN_CACHE_TTL = 3600
+_token_cache = {}  # email -> (token, expires_at)
+_redis_client = None
+REDIS_URL = os.getenv("REDIS_URL")
+
+def _get_redis_client():
+    """Lazily create the Redis client used for the shared token cache, if configured."""
+    global _redis_client
+    if _redis_client is None and redis is not None and REDIS_URL:
+        _redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return _redis_client
+
+def _token_cache_key(email):
+    return f"ecrf:token:{email}"
+
 ## Patient Data Exporter
 class PatientDataExporter:
-    def __init__(self, pathforjsons, samples, api_url, resume=False, max_workers=20):
+    def __init__(self, pathforjsons, samples, api_url, resume=False, max_workers=20, return_data=False):
         self.pathforjsons = pathforjsons
         self.samples = samples
         self.api_url = api_url
         self.resume = resume
         self.max_workers = max_workers
+        # When set, fetched records are kept in memory and returned instead of written as JSON files
+        self.return_data = return_data
         self.session = self._create_session()
-        self.token = self._load_token()
         self._setup_logging()
+        self.token = self._get_cached_token()
         self._create_output_directory()
 
     def _create_session(self):
@@ -78,6 +115,50 @@ class PatientDataExporter:
         except requests.exceptions.RequestException as e:
             raise ValueError(f"Authentication request failed: {e}")
 
+    def _get_cached_token(self):
+        """Return a cached auth token for ECRF_EMAIL, logging in only when none is cached."""
+        email = os.getenv("ECRF_EMAIL")
+        cached = _token_cache.get(email)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        
+        client = _get_redis_client()
+        if client is not None:
+            try:
+                token = client.get(_token_cache_key(email))
+                if token:
+                    _token_cache[email] = (token, time.monotonic() + TOKEN_CACHE_TTL)
+                    return token
+            except redis.RedisError as e:
+                self.logger.warning(f"Could not read cached eCRF token from Redis: {e}")
+        
+        token = self._load_token()
+        _token_cache[email] = (token, time.monotonic() + TOKEN_CACHE_TTL)
+        if client is not None:
+            try:
+                client.setex(_token_cache_key(email), TOKEN_CACHE_TTL, token)
+            except redis.RedisError as e:
+                self.logger.warning(f"Could not cache eCRF token in Redis: {e}")
+        return token
+
+    def _invalidate_token(self):
+        """Drop the cached auth token for ECRF_EMAIL, e.g. after the API rejects it."""
+        email = os.getenv("ECRF_EMAIL")
+        _token_cache.pop(email, None)
+        client = _get_redis_client()
+        if client is not None:
+            try:
+                client.delete(_token_cache_key(email))
+            except redis.RedisError as e:
+                self.logger.warning(f"Could not invalidate cached eCRF token in Redis: {e}")
+
+    async def _refresh_token(self, stale_token):
+        """Replace a rejected token once, even if several requests see the 401 concurrently."""
+        async with self._token_lock:
+            if self.token == stale_token:
+                self._invalidate_token()
+                self.token = await asyncio.to_thread(self._get_cached_token)
+
     def _setup_logging(self):
         """
         Sets up logging to write to a log file in the specified directory.
@@ -85,82 +166,132 @@ class PatientDataExporter:
         os.makedirs(self.pathforjsons, exist_ok=True)
         log_file = os.path.join(self.pathforjsons, 'data_export.log')
         
-        logging.basicConfig(
-            filename=log_file,
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            force=True
-        )
-        logging.info("Logging setup complete.")
+        # A private logger per exporter, so runs sharing a process (e.g. in the API) keep separate log files
+        # and the host's root logging configuration is left untouched
+        self.logger = logging.Logger(f"{__name__}.export", level=logging.INFO)
+        self._log_handler = logging.FileHandler(log_file)
+        self._log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        self.logger.addHandler(self._log_handler)
+        self.logger.info("Logging setup complete.")
+
+    def close_logging(self):
+        """Close the exporter's log file."""
+        self.logger.removeHandler(self._log_handler)
+        self._log_handler.close()
 
     def _create_output_directory(self):
         # No longer uses os.chdir, just ensures the directory exists.
         os.makedirs(self.pathforjsons, exist_ok=True)
 
-    def _fetch_patient_data(self, patient_id):
-        """Fetch data for a single patient"""
+    async def _fetch_patient_data(self, client, patient_id, parse=True):
+        """
+        Fetch data for a single patient, retrying transient HTTP errors with exponential backoff
+        and refreshing the auth token once if it is rejected.
+        With parse=False the raw response bytes are returned instead of the decoded JSON.
+        """
         url = f"{self.api_url}{patient_id}"
-        headers = {'Authorization': f'Bearer {self.token}'}
+        token_refreshed = False
+        attempt = 0
         
-        try:
-            response = self.session.get(url, headers=headers, timeout=30)
-            if response.status_code == 200:
-                return patient_id, response.json()
-            else:
-                logging.error(f"Error fetching data for {patient_id}. Status code: {response.status_code}")
+        # The one-off token refresh does not use up a retry, so every path ends in a return below
+        while True:
+            try:
+                token = self.token
+                response = await client.get(url, headers={'Authorization': f'Bearer {token}'})
+                if response.status_code == 200:
+                    return patient_id, orjson.loads(response.content) if parse else response.content
+                if response.status_code == 401 and not token_refreshed:
+                    token_refreshed = True
+                    await self._refresh_token(token)
+                    continue
+                if response.status_code in FETCH_RETRY_STATUSES and attempt < FETCH_RETRIES:
+                    await asyncio.sleep(FETCH_BACKOFF_FACTOR * 2 ** attempt)
+                    attempt += 1
+                    continue
+                self.logger.error(f"Error fetching data for {patient_id}. Status code: {response.status_code}")
+                return patient_id, None
+            except Exception as e:
+                self.logger.error(f"Exception fetching data for {patient_id}: {e}")
                 return patient_id, None
-        except Exception as e:
-            logging.error(f"Exception fetching data for {patient_id}: {e}")
-            return patient_id, None
 
     def _export_patient_data(self, patient_id, patient_data):
-        """Export patient data to a JSON file in the designated directory."""
+        """
+        Export patient data to a JSON file in the designated directory.
+        Raw response bytes are written as-is; decoded data is serialized with orjson.
+        """
         output_file = os.path.join(self.pathforjsons, f"{patient_id}_data.json")
-        with open(output_file, 'w') as json_file:
-            json.dump(patient_data, json_file, indent=2)
-        logging.info(f"Data for {patient_id} exported successfully to {output_file}")
+        if not isinstance(patient_data, bytes):
+            patient_data = orjson.dumps(patient_data)
+        with open(output_file, 'wb') as json_file:
+            json_file.write(patient_data)
+        self.logger.info(f"Data for {patient_id} exported successfully to {output_file}")
 
-    def fetch_and_export_data(self, patient_id):
+    async def fetch_and_export_data(self, client, semaphore, patient_id):
         """Fetch and export data for a single patient, using full paths."""
         output_file = os.path.join(self.pathforjsons, f"{patient_id}_data.json")
         if self.resume and os.path.exists(output_file):
-            logging.info(f"Skipping {patient_id}, file already exists.")
+            self.logger.info(f"Skipping {patient_id}, file already exists.")
             return patient_id, None
         
-        patient_id, patient_data = self._fetch_patient_data(patient_id)
-        if patient_data:
-            self._export_patient_data(patient_id, patient_data)
+        async with semaphore:
+            # Data that only goes to disk is passed through as raw bytes, skipping a parse/serialize round-trip
+            patient_id, patient_data = await self._fetch_patient_data(client, patient_id, parse=self.return_data)
+            if patient_data and not self.return_data:
+                # Keep the event loop free while the file is written
+                await asyncio.to_thread(self._export_patient_data, patient_id, patient_data)
         return patient_id, patient_data
 
+    async def _process_patients_async(self, patient_ids):
+        """
+        Fetch all patients on a single event loop, with at most max_workers requests in flight.
+        Requests are multiplexed over a few HTTP/2 connections when the server supports it.
+        """
+        semaphore = asyncio.Semaphore(self.max_workers)
+        # With HTTP/2 all requests share one connection; the pool size only matters if the server falls back to HTTP/1.1.
+        # Connection-level failures are retried by the transport; HTTP status retries happen in _fetch_patient_data
+        limits = httpx.Limits(max_connections=self.max_workers, max_keepalive_connections=self.max_workers)
+        transport = httpx.AsyncHTTPTransport(http2=True, retries=FETCH_RETRIES, limits=limits)
+        self._token_lock = asyncio.Lock()
+        completed = 0
+        records = []
+        
+        async with httpx.AsyncClient(transport=transport, timeout=30) as client:
+            async def process_one(patient_id):
+                nonlocal completed
+                try:
+                    _, patient_data = await self.fetch_and_export_data(client, semaphore, patient_id)
+                    if patient_data and self.return_data:
+                        records.append((patient_id, patient_data))
+                    completed += 1
+                    print(f'Processed {completed}/{len(patient_ids)}: {patient_id}', end="\r")
+                except Exception as e:
+                    self.logger.error(f"Exception processing {patient_id}: {e}")
+            
+            await asyncio.gather(*(process_one(patient_id) for patient_id in patient_ids))
+        return records
+
     def process_patients(self):
-        """Process all patients concurrently"""
+        """
+        Process all patients concurrently.
+        Returns a list of (patient_id, data) tuples when return_data is set, otherwise None.
+        """
         try:
-            pat_df = pd.read_csv(self.samples, header=None)
-            patient_ids = pat_df[0].astype(str).str.strip().tolist()
+            # Read the single ID column as strings and drop blanks inside pandas
+            ids = pd.read_csv(self.samples, header=None, usecols=[0], dtype=str).iloc[:, 0].str.strip()
+            patient_ids = ids[ids.notna() & (ids != '')].tolist()
         except FileNotFoundError:
-            logging.error(f"Samples file not found at {self.samples}")
+            self.logger.error(f"Samples file not found at {self.samples}")
             return
         
-        patient_ids = [pid for pid in patient_ids if pid]
         print(f"Processing {len(patient_ids)} patients with {self.max_workers} workers...")
         
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            future_to_patient = {
-                executor.submit(self.fetch_and_export_data, patient_id): patient_id 
-                for patient_id in patient_ids
-            }
-            
-            completed = 0
-            for future in as_completed(future_to_patient):
-                patient_id = future_to_patient[future]
-                try:
-                    future.result()
-                    completed += 1
-                    print(f'Processed {completed}/{len(patient_ids)}: {patient_id}', end="\r")
-                except Exception as e:
-                    logging.error(f"Exception processing {patient_id}: {e}")
+        if uvloop is not None:
+            records = uvloop.run(self._process_patients_async(patient_ids))
+        else:
+            records = asyncio.run(self._process_patients_async(patient_ids))
         
         print(f"\nCompleted processing {len(patient_ids)} patients.")
+        return records if self.return_data else None
 
     def __del__(self):
         """Clean up session"""
@@ -168,52 +299,138 @@ class PatientDataExporter:
             self.session.close()
 
 
-# Optimized Cancer Details Processing
-def process_cancer_details_optimized(json_directory, output_dir, info="cancerDetails", output_pq_name="cancerDetails.parquet", resume=False):
+# Optimized Clinical Details Processing
+CLINICAL_SECTIONS = ("cancerDetails", "patientInfo", "medicalInfo")
+
+def _extract_sections(patient_id, data, sections=CLINICAL_SECTIONS):
     """
-    Optimized version that processes JSON files and saves parquet to a specified output directory.
+    Returns {section: record} for every section present in a patient's eCRF response,
+    each record tagged with the patientID.
     """
-    json_list = [file for file in os.listdir(json_directory) if file.endswith('.json')]
-    
-    info_directory = os.path.join(json_directory, info)
-    os.makedirs(info_directory, exist_ok=True)
-    
-    all_data = []
+    extracted = {}
+    # The sections live under the first key that is not a response status field (e.g. 'payLoad')
+    payload = next((value for key, value in data.items() if key not in ('success', 'message')), None)
+    if isinstance(payload, dict):
+        for info in sections:
+            section_data = payload.get(info)
+            if isinstance(section_data, dict) and section_data:
+                extracted[info] = {**section_data, 'patientID': patient_id}
+    return extracted
+
+def _compile_extractor(template, sep='_'):
+    """
+    Generates a straight-line function that flattens records shaped like `template` the same way
+    _flatten_record does (nested keys joined with `sep`). The function raises KeyError (or TypeError)
+    for a record whose shape differs from the template.
+    """
+    checks, fields = [], []
+
+    def walk(node, expr, prefix):
+        checks.append(f"len({expr}) != {len(node)}")
+        for key, value in node.items():
+            child = f"{expr}[{key!r}]"
+            if isinstance(value, dict):
+                checks.append(f"type({child}) is not dict")
+                walk(value, child, prefix + (key,))
+            else:
+                checks.append(f"type({child}) is dict")
+                fields.append(f"{sep.join(prefix + (key,))!r}: {child}")
+
+    walk(template, "d", ())
+    source = (
+        "def extract(d):\n"
+        f"    if {' or '.join(checks)}:\n"
+        "        raise KeyError('record shape differs from template')\n"
+        f"    return {{{', '.join(fields)}}}\n"
+    )
+    namespace = {}
+    exec(source, namespace)
+    return namespace["extract"]
+
+def _flatten_record(record, sep='_', prefix=''):
+    """Flattens nested dicts into a single level, joining keys with `sep` (as pd.json_normalize does)."""
+    flat = {}
+    for key, value in record.items():
+        name = f"{prefix}{sep}{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(_flatten_record(value, sep, name))
+        else:
+            flat[name] = value
+    return flat
+
+def _normalize_records(records, sep='_'):
+    """
+    Flattens nested records into a polars DataFrame using an extractor compiled from the first record.
+    Falls back to the generic _flatten_record when the records do not all share the same shape.
+    """
+    extract = _compile_extractor(records[0], sep)
+    try:
+        rows = [extract(record) for record in records]
+    except (KeyError, TypeError):
+        rows = [_flatten_record(record, sep) for record in records]
+    # Scan every row for the schema since fields can be missing or null in early records
+    return pl.DataFrame(rows, infer_schema_length=None, strict=False)
+
+def _parse_one(input_path, sections=CLINICAL_SECTIONS):
+    """
+    Parses a single patient JSON file and extracts its clinical sections.
+    Module-level so it can be pickled for the process pool.
+    """
+    json_file = os.path.basename(input_path)
+    try:
+        with open(input_path, 'rb') as f:
+            data = orjson.loads(f.read())
+        return _extract_sections(json_file.replace('_data.json', ''), data, sections)
+    except Exception as e:
+        print(f"Error processing {json_file}: {e}")
+    return {}
+
+def _join_sections(left, right):
+    """
+    Inner-joins two section frames on patientID, suffixing overlapping columns with _x/_y
+    so the output columns match the previous pandas merge.
+    """
+    overlap = (set(left.columns) & set(right.columns)) - {"patientID"}
+    left = left.rename({column: f"{column}_x" for column in overlap})
+    right = right.rename({column: f"{column}_y" for column in overlap})
+    return left.join(right, on="patientID", how="inner")
+
+def _merge_sections(section_rows):
+    """
+    Flattens each section's records in a single call and joins them on patientID with polars
+    (or returns None if any section has no data).
+    """
+    for info, rows in section_rows.items():
+        if not rows:
+            print(f"\nNo data found for {info}", file=sys.stderr)
+            return None
     
-    for json_file in json_list:
-        input_path = os.path.join(json_directory, json_file)
-        
-        try:
-            df = pd.read_json(input_path)
-            df.drop(['success', 'message'], axis=1, inplace=True, errors='ignore')
-            df = df.T
-            
-            if info in df.columns:
-                extracted_data = df[info].iloc[0] if len(df) > 0 else {}
-                if extracted_data:
-                    normalized_data = pd.json_normalize(extracted_data, sep='_')
-                    normalized_data['patientID'] = json_file.replace('_data.json', '')
-                    all_data.append(normalized_data)
-                    
-        except Exception as e:
-            print(f"Error processing {json_file}: {e}")
-            continue
+    cancer_df, patient_df, medical_df = (_normalize_records(section_rows[info]) for info in CLINICAL_SECTIONS)
+    return _join_sections(_join_sections(cancer_df, patient_df), medical_df)
+
+def process_all_sections(json_directory):
+    """
+    Scans every patient JSON file once, extracting the cancer, patient and medical sections together,
+    and returns them merged on patientID. JSON files are parsed in parallel across CPU cores.
+    """
+    json_paths = [os.path.join(json_directory, file) for file in os.listdir(json_directory) if file.endswith('.json')]
     
-    if all_data:
-        # Filter out empty dataframes to prevent a FutureWarning from pd.concat
-        all_data = [df for df in all_data if not df.empty]
-        if not all_data:
-            return # Exit if all dataframes were empty
-
-        final_df = pd.concat(all_data, ignore_index=True)
-        # Save the final parquet file to the specified output directory
-        output_path = os.path.join(output_dir, f"{info}_{output_pq_name}")
-        final_df.to_parquet(output_path)
-        # Quieter output: The following print statement has been removed.
-        # print(f"\nIntermediate data for '{info}' saved to {output_path}")
-    # else:
-        # Quieter output: The following print statement has been removed.
-        # print(f"\nNo data found for {info}")
+    section_rows = {info: [] for info in CLINICAL_SECTIONS}
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for extracted in executor.map(_parse_one, json_paths, chunksize=16):
+            for info, record in extracted.items():
+                section_rows[info].append(record)
+    return _merge_sections(section_rows)
+
+def process_all_sections_from_memory(patient_records):
+    """
+    Same as process_all_sections, but for (patient_id, data) tuples already held in memory.
+    """
+    section_rows = {info: [] for info in CLINICAL_SECTIONS}
+    for patient_id, data in patient_records:
+        for info, record in _extract_sections(patient_id, data).items():
+            section_rows[info].append(record)
+    return _merge_sections(section_rows)
 
 def process_data(input_dir, output_dir, resume=False, max_workers=10):  
     """
@@ -221,68 +438,59 @@ def process_data(input_dir, output_dir, resume=False, max_workers=10):
     """
     # Ensure the output directory exists before creating a temp directory inside it
     os.makedirs(output_dir, exist_ok=True)
-    temp_dir = tempfile.mkdtemp(dir=output_dir, prefix="ecrf_json_")
+    # The context manager removes the JSON scratch directory on exit, including
+    # when an exception escapes; cleanup errors are ignored rather than masking them
+    with tempfile.TemporaryDirectory(dir=output_dir, prefix="ecrf_json_", ignore_cleanup_errors=True) as temp_dir:
+        pathforjsons = os.path.join(temp_dir, 'json_response')
+        samples = os.path.join(input_dir, "retrieved_list.txt") # Read from the input directory
+        api_url = "https://www.v2.api.ecrf.4basecare.co.in/integration/getExternalApiResponseByPatientId/"
     
-    pathforjsons = os.path.join(temp_dir, 'json_response')
-    samples = os.path.join(input_dir, "retrieved_list.txt") # Read from the input directory
-    api_url = "https://www.v2.api.ecrf.4basecare.co.in/integration/getExternalApiResponseByPatientId/"
-    
-    try:
-        if not resume:
-            exporter = PatientDataExporter(pathforjsons, samples, api_url, resume=resume, max_workers=max_workers)
-            exporter.process_patients()
-        
-        # Process details, saving intermediate parquet to the temp directory
-        process_cancer_details_optimized(pathforjsons, temp_dir, info="cancerDetails", output_pq_name="cancerDetails.parquet", resume=resume)
-        process_cancer_details_optimized(pathforjsons, temp_dir, info="patientInfo", output_pq_name="patientDetails.parquet", resume=resume)
-        process_cancer_details_optimized(pathforjsons, temp_dir, info="medicalInfo", output_pq_name="medicalDetails.parquet", resume=resume)
-        
-        # Merge the data from the temp directory
+        exporter = None
         try:
-            cancer_df_path = os.path.join(temp_dir, "cancerDetails_cancerDetails.parquet")
-            patient_df_path = os.path.join(temp_dir, "patientInfo_patientDetails.parquet")
-            medical_df_path = os.path.join(temp_dir, "medicalInfo_medicalDetails.parquet")
-            
-            cancer_df = pd.read_parquet(cancer_df_path)
-            patient_df = pd.read_parquet(patient_df_path)
-            medical_df = pd.read_parquet(medical_df_path)
-            
-            clinical_df = cancer_df.merge(patient_df, on="patientID", how="inner")
-            final_df = clinical_df.merge(medical_df, on="patientID", how="inner")
+            # Extract all clinical sections in a single pass: from memory on a fresh run,
+            # or from the JSON files already on disk when resuming
+            try:
+                if not resume:
+                    exporter = PatientDataExporter(pathforjsons, samples, api_url, resume=resume, max_workers=max_workers, return_data=True)
+                    final_df = process_all_sections_from_memory(exporter.process_patients() or [])
+                else:
+                    final_df = process_all_sections(pathforjsons)
+                if final_df is not None:
+                    # Save the final output to the designated output directory
+                    final_output_path = os.path.join(output_dir, "clinical_Details.parquet")
+                    final_df.write_parquet(final_output_path, compression='zstd')
+                    print(f"Final merged data saved to: {final_output_path}")
             
-            # Save the final output to the designated output directory
-            final_output_path = os.path.join(output_dir, "clinical_Details.parquet")
-            final_df.to_parquet(final_output_path, index=False)
-            print(f"Final merged data saved to: {final_output_path}")
-            
-        except FileNotFoundError as e:
-            print(f"\nError: Could not find intermediate file for merging: {e}", file=sys.stderr)
-        except Exception as e:
-            print(f"\nAn error occurred during the final merge: {e}", file=sys.stderr)
+            except FileNotFoundError as e:
+                print(f"\nError: Could not find patient JSON files for merging: {e}", file=sys.stderr)
+            except Exception as e:
+                print(f"\nAn error occurred during the final merge: {e}", file=sys.stderr)
     
-    finally:
-        # Shut down logging to release file locks before cleanup
-        logging.shutdown()
-        # Clean up the temporary directory for JSONs, handling potential errors
-        try:
-            shutil.rmtree(temp_dir)
-        except OSError as e:
-            print(f"Warning: Could not remove temporary directory {temp_dir}. Reason: {e}", file=sys.stderr)
+        finally:
+            # Close the exporter's log file to release file locks before cleanup
+            if exporter is not None:
+                exporter.close_logging()
 
 
-def main():
-    """
-    Main execution block that sets up and cleans up a temporary directory.
-    """
+def build_parser():
+    """Build the argument parser shared by the CLI and in-process callers."""
     parser = argparse.ArgumentParser(description='Extract and process clinical data.')
     parser.add_argument('--input_dir', type=str, required=True, help='Directory containing input files like retrieved_list.txt')
     parser.add_argument('--output_dir', type=str, required=True, help='Directory to save the final clinical_Details.parquet file.')
     parser.add_argument('--resume', action='store_true', help='Resume processing from existing files')
     parser.add_argument('--workers', type=int, default=20, help='Number of concurrent workers (default: 20)')
-    args = parser.parse_args()
-    
+    return parser
+
+def run(args):
+    """Extract clinical data for an already-parsed argument namespace."""
     # The tempfile management is now handled within process_data
     process_data(args.input_dir, args.output_dir, args.resume, args.workers)
 
+def main():
+    """
+    Main execution block that sets up and cleans up a temporary directory.
+    """
+    run(build_parser().parse_args())
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,22 +1,41 @@
 from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Security
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, Response
 from fastapi.security import APIKeyHeader
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from typing import Optional, List, Dict, Any
-import subprocess
 import os
-import json
+import orjson
 import asyncio
 import uuid
+import time
 import hashlib
 from datetime import datetime
-import tempfile
 import logging
-import sys
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xlsxwriter
 from dotenv import load_dotenv
 import shutil
 import secrets
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Redis is optional; job status falls back to process memory
+    aioredis = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional; results are then stored in Redis uncompressed
+    zstandard = None
+
+try:
+    from src import run_pipeline_pq
+except ImportError:  # Executed directly as `python src/otwin8_api.py`
+    import run_pipeline_pq
 
 load_dotenv(override=True)
 
@@ -26,8 +45,99 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI(title="OncoTwin Simplified API", version="1.0.0")
 
-job_status_memory = {}
-cache_memory = {}
+# --- In-memory Storage ---
+
+class TTLCache:
+    """
+    Bounded in-memory store that evicts entries after their TTL and, once full,
+    evicts the least recently used entry.
+    """
+
+    def __init__(self, max_size: int, default_ttl: float):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key: str, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if time.monotonic() > expires_at:
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value, ttl: Optional[float] = None):
+        self._data[key] = (time.monotonic() + (ttl if ttl is not None else self.default_ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key: str, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Job status is kept in Redis when REDIS_URL is set, so it survives restarts and is shared across workers
+REDIS_URL = os.getenv("REDIS_URL")
+JOB_STATUS_TTL = 86400  # 24 hours
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+redis_client = None
+
+job_status_memory = TTLCache(max_size=10000, default_ttl=JOB_STATUS_TTL)
+cache_memory = TTLCache(max_size=1024, default_ttl=7200)
+
+# Raw bytes of recently finished jobs' combined JSON, served by /results without parsing or re-serializing
+RESULTS_BYTES_CACHE_SIZE = 32
+RESULTS_BYTES_TTL = 7200  # Lifetime of the copy kept in Redis
+RESULTS_ZSTD_LEVEL = 3
+ZSTD_FRAME_MAGIC = b"\x28\xb5\x2f\xfd"  # Every zstd frame starts with these bytes; JSON never does
+results_bytes_cache: "OrderedDict[str, bytes]" = OrderedDict()
+
+# Per-job locks so concurrent Excel downloads build the workbook only once
+excel_locks: Dict[str, asyncio.Lock] = {}
+
+# Root for per-job output directories, resolved once at startup (the API runs from the repository root)
+API_OUTPUTS_DIR = os.path.join(os.getcwd(), "api_outputs")
+
+# Job output directories older than this whose job status is gone are removed by a periodic sweep
+OUTPUTS_TTL = 7200
+OUTPUTS_SWEEP_INTERVAL = 600
+outputs_sweeper: Optional[asyncio.Task] = None
+
+# Maximum number of batch jobs processed at once; further jobs wait in 'pending'
+MAX_JOBS = int(os.getenv("MAX_JOBS", "4"))
+JOB_SEMAPHORE = asyncio.Semaphore(MAX_JOBS)
+
+# Pipeline tasks run in a pool of long-lived worker processes, so CPU-heavy steps never hold the API's GIL;
+# set PIPELINE_SUBPROCESS=0 to run them on threads of the API process instead
+PIPELINE_SUBPROCESS = os.getenv("PIPELINE_SUBPROCESS", "1") == "1"
+pipeline_pool: Optional[ProcessPoolExecutor] = None
+# Threads for in-process pipeline runs, kept apart from the loop's default executor used by short to_thread calls
+pipeline_threads: Optional[ThreadPoolExecutor] = None
+
+# Return codes of a killed pipeline (SIGKILL / OOM killer); only these failures are retried
+TRANSIENT_RETURN_CODES = (None, -9, 137)
+
+# Maximum number of doctor sub-tasks run at once within a single batch job
+PIPELINE_CONCURRENCY = int(os.getenv("PIPELINE_CONCURRENCY", str(os.cpu_count() or 1)))
+
+# Pipelines can run at once up to the worker pool's size (processes) or every job's sub-tasks (threads); unless
+# TWIN_MATCH_WORKERS is set, each gets an equal share of the cores for its matching threads instead of all of them
+if "TWIN_MATCH_WORKERS" not in os.environ:
+    concurrent_pipelines = max(1, PIPELINE_CONCURRENCY) * (1 if PIPELINE_SUBPROCESS else max(1, MAX_JOBS))
+    os.environ["TWIN_MATCH_WORKERS"] = str(max(1, (os.cpu_count() or 1) // concurrent_pipelines))
+# Spawned workers and steps read the variable on import; the matching module imported here (before .env was
+# loaded) is updated directly
+run_pipeline_pq.twin_algo_pq.TWIN_MATCH_WORKERS = int(os.environ["TWIN_MATCH_WORKERS"])
 
 # --- Authentication Configuration ---
 API_KEY_HEADER = APIKeyHeader(name="X-API-Key", auto_error=False)
@@ -59,16 +169,22 @@ def verify_api_key(api_key: str = Security(API_KEY_HEADER)):
 
 # Represents a single request within a batch
 class SingleRequest(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     doctor_id: int
     patient_ids: List[str]
 
 # The main request body for the batch endpoint
 class BatchPipelineRequest(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     requests: List[SingleRequest]
     refresh: bool = False
 
 # The simplified status response sent to the user
 class JobStatusResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     job_id: str
     status: str
     message: str
@@ -80,6 +196,8 @@ class JobStatusResponse(BaseModel):
 
 # Internal model for storing detailed job status in Redis/memory
 class InternalJobStatus(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     job_id: str
     status: str
     message: str
@@ -90,70 +208,179 @@ class InternalJobStatus(BaseModel):
 
 def get_cache_key(request: SingleRequest) -> str:
     """Generate a cache key based on request parameters"""
-    # Sort patient IDs and join them with underscores for consistent cache keys
-    sorted_patient_ids = "_".join(sorted(request.patient_ids))
-    content = f"{request.doctor_id}_{sorted_patient_ids}"
-    return hashlib.md5(content.encode()).hexdigest()
-
-def get_job_status(job_id: str) -> Optional[Dict]:
-    """Get job status from in-memory storage."""
+    # Feed the doctor ID and the sorted patient IDs to blake2b incrementally, without building one big string
+    h = hashlib.blake2b(digest_size=16)
+    # str() handles doctor IDs of any size; the separator keeps the ID from running into the first patient ID
+    h.update(str(request.doctor_id).encode())
+    h.update(b'\x00')
+    for patient_id in sorted(request.patient_ids):
+        h.update(patient_id.encode())
+        h.update(b'\x00')
+    return h.hexdigest()
+
+def get_job_key(job_id: str) -> str:
+    """Redis hash key holding the status of a job"""
+    return f"job:{job_id}"
+
+async def get_job_status(job_id: str) -> Optional[Dict]:
+    """Get job status from Redis, or from in-memory storage if Redis is not configured."""
+    if redis_client is not None:
+        fields = await redis_client.hgetall(get_job_key(job_id))
+        if not fields:
+            return None
+        return {field.decode(): orjson.loads(value) for field, value in fields.items()}
     return job_status_memory.get(job_id)
 
-def set_job_status(job_id: str, status_data: Dict):
-    """Set job status in in-memory storage."""
-    job_status_memory[job_id] = status_data
+async def set_job_status(job_id: str, status_data: Dict):
+    """Set job status in Redis (with a TTL), or in in-memory storage if Redis is not configured."""
+    if redis_client is not None:
+        key = get_job_key(job_id)
+        # Each field is JSON-encoded so lists and nested dicts fit in a flat hash
+        # HSET and EXPIRE go out in one round trip
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(
+                key, mapping={field: orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS) for field, value in status_data.items()}
+            )
+            pipe.expire(key, JOB_STATUS_TTL)
+            await pipe.execute()
+        return
+    job_status_memory.set(job_id, status_data)
+
+# HSET + EXPIRE applied only if the job hash still exists, so an update racing with DELETE /job can't resurrect it
+UPDATE_JOB_STATUS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+async def update_job_status(job_id: str, fields: Dict) -> bool:
+    """
+    Atomically update some fields of an existing job status, in one round trip when Redis is used.
+    Returns False (and writes nothing) if the job no longer exists.
+    """
+    if redis_client is not None:
+        args = [JOB_STATUS_TTL]
+        for field, value in fields.items():
+            args.extend((field, orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)))
+        return bool(await redis_client.eval(UPDATE_JOB_STATUS_SCRIPT, 1, get_job_key(job_id), *args))
+    job_data = job_status_memory.get(job_id)
+    if job_data is None:
+        return False
+    job_data.update(fields)
+    job_status_memory.set(job_id, job_data)
+    return True
+
+async def delete_job_status(job_id: str) -> None:
+    """Remove a job status from Redis or in-memory storage."""
+    if redis_client is not None:
+        await redis_client.delete(get_job_key(job_id))
+        return
+    job_status_memory.pop(job_id, None)
+
+async def count_job_statuses() -> int:
+    """Count the job statuses currently stored."""
+    if redis_client is not None:
+        count = 0
+        async for _ in redis_client.scan_iter(match=get_job_key("*"), count=1000):
+            count += 1
+        return count
+    return len(job_status_memory)
 
 def get_cache(cache_key: str) -> Optional[Dict]:
     """Get cached result from in-memory storage."""
     return cache_memory.get(cache_key)
 
-def set_cache(cache_key: str, data: Dict, ttl: int = 7200):  # TTL is noted but not enforced
-    """Set cached result in in-memory storage."""
-    cache_memory[cache_key] = data
-
-def create_samples_file(patient_ids: List[str], job_id: str) -> str:
-    """Create a temporary samples file for the pipeline"""
-    samples_file = f"temp_samples_{job_id}.txt"
-    with open(samples_file, 'w') as f:
-        for patient_id in patient_ids:
-            f.write(f"{patient_id}\n")
-    return samples_file
-
-def generate_excel_output(json_data: Dict, job_id: str) -> str:
-    """Convert JSON results to Excel format"""
-    excel_file = f"results_{job_id}.xlsx"
-    
-    try:
-        with pd.ExcelWriter(excel_file, engine='openpyxl') as writer:
-            # Process each data type
-            for key, data in json_data.items():
-                if isinstance(data, list) and data:
-                    df = pd.DataFrame(data)
-                    sheet_name = key[:31]  # Excel sheet name limit
-                    df.to_excel(writer, sheet_name=sheet_name, index=False)
-                elif isinstance(data, dict):
-                    # Convert dict to DataFrame
-                    df = pd.DataFrame([data])
-                    sheet_name = key[:31]
-                    df.to_excel(writer, sheet_name=sheet_name, index=False)
-        
-        return excel_file
-    except Exception as e:
-        logger.error(f"Error creating Excel file: {e}")
-        return None
+def set_cache(cache_key: str, data: Dict, ttl: int = 7200):
+    """Set cached result in in-memory storage, expiring after `ttl` seconds."""
+    cache_memory.set(cache_key, data, ttl=ttl)
+
+def get_results_bytes(job_id: str) -> Optional[bytes]:
+    """Get the cached combined JSON bytes of a job, marking them as recently used."""
+    data = results_bytes_cache.get(job_id)
+    if data is not None:
+        results_bytes_cache.move_to_end(job_id)
+    return data
+
+def set_results_bytes(job_id: str, data: bytes):
+    """Cache the combined JSON bytes of a job, evicting the least recently used entries."""
+    results_bytes_cache[job_id] = data
+    results_bytes_cache.move_to_end(job_id)
+    while len(results_bytes_cache) > RESULTS_BYTES_CACHE_SIZE:
+        results_bytes_cache.popitem(last=False)
+
+def get_results_key(job_id: str) -> str:
+    """Redis key holding the combined JSON bytes of a job"""
+    return f"job_results:{job_id}"
+
+async def fetch_results_bytes(job_id: str) -> Optional[bytes]:
+    """Get a job's combined JSON bytes from this process's cache, falling back to Redis when configured."""
+    data = get_results_bytes(job_id)
+    if data is None and redis_client is not None:
+        data = await redis_client.get(get_results_key(job_id))
+        if data is not None and data.startswith(ZSTD_FRAME_MAGIC):
+            if zstandard is None:
+                logger.warning(f"Results for job {job_id} are zstd-compressed in Redis but zstandard is not installed.")
+                return None
+            data = await asyncio.to_thread(zstandard.ZstdDecompressor().decompress, data)
+        if data is not None:
+            set_results_bytes(job_id, data)
+    return data
+
+async def store_results_bytes(job_id: str, data: bytes):
+    """Cache a job's combined JSON bytes in this process and, when configured, in Redis for other workers."""
+    set_results_bytes(job_id, data)
+    if redis_client is not None:
+        # Match JSON is highly repetitive, so the Redis copy is zstd-compressed when zstandard is available
+        blob = data
+        if zstandard is not None:
+            blob = await asyncio.to_thread(zstandard.ZstdCompressor(level=RESULTS_ZSTD_LEVEL).compress, data)
+        await redis_client.setex(get_results_key(job_id), RESULTS_BYTES_TTL, blob)
 
 # --- Helper functions for the new batch process ---
 
-async def run_single_pipeline_task(job_id: str, request: SingleRequest, refresh: bool) -> Dict:
+def get_pipeline_pool() -> ProcessPoolExecutor:
+    """Return the shared pipeline worker pool, starting it on first use."""
+    global pipeline_pool
+    if pipeline_pool is None:
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        pipeline_pool = ProcessPoolExecutor(
+            max_workers=max(1, PIPELINE_CONCURRENCY), mp_context=multiprocessing.get_context(method)
+        )
+    return pipeline_pool
+
+def get_pipeline_threads() -> ThreadPoolExecutor:
+    """Return the thread pool for in-process pipeline runs, sized for every job's concurrent sub-tasks."""
+    global pipeline_threads
+    if pipeline_threads is None:
+        pipeline_threads = ThreadPoolExecutor(
+            max_workers=max(1, MAX_JOBS) * max(1, PIPELINE_CONCURRENCY), thread_name_prefix="pipeline"
+        )
+    return pipeline_threads
+
+def reset_pipeline_pool():
+    """Discard the shared pipeline worker pool, e.g. after one of its workers died."""
+    global pipeline_pool
+    if pipeline_pool is not None:
+        pipeline_pool.shutdown(wait=False, cancel_futures=True)
+        pipeline_pool = None
+
+async def run_single_pipeline_task(
+    job_id: str, request: SingleRequest, refresh: bool, cache_key: Optional[str] = None, check_cache: bool = True
+) -> Dict:
     """
     Runs the pipeline for a single doctor's list and returns the output directory.
     This function is designed to be run concurrently and supports caching.
+    Callers that already hold the cache key, or have just missed the cache, can pass cache_key / check_cache=False.
     """
     doctor_id = request.doctor_id
 
     # --- Caching Logic ---
-    cache_key = get_cache_key(request)
-    if not refresh:
+    if cache_key is None:
+        cache_key = get_cache_key(request)
+    if not refresh and check_cache:
         cached_result = get_cache(cache_key)
         if cached_result:
             # Check if the cached files still exist on disk
@@ -164,53 +391,60 @@ async def run_single_pipeline_task(job_id: str, request: SingleRequest, refresh:
                     "doctor_id": doctor_id,
                     "status": "completed_from_cache",
                     "json_path": cached_files["json"],
-                    "excel_path": cached_files["excel"],
+                    "parquet_path": cached_files["parquet"],
                     "error": None,
                 }
             else:
                 logger.warning(f"Cache hit for doctor_id {doctor_id}, but output files are missing. Re-running.")
 
     # Create a dedicated directory for this sub-task's intermediate files
-    sub_task_dir = os.path.join(os.getcwd(), "api_outputs", job_id, str(doctor_id))
+    sub_task_dir = os.path.join(API_OUTPUTS_DIR, job_id, str(doctor_id))
     os.makedirs(sub_task_dir, exist_ok=True)
     
-    samples_file = None
     try:
-        samples_file = create_samples_file(request.patient_ids, f"{job_id}_{doctor_id}")
-        
-        cmd = [
-            sys.executable, "src/run_pipeline_pq.py",
-            "--samples", samples_file,
+        # Patient IDs are handed to the pipeline directly ('-'), so no temp samples file is written
+        pipeline_args = [
+            "--samples", "-",
             "--output_dir", sub_task_dir,
             "--doctor_id", str(doctor_id),
             "--json_output",
         ]
         if refresh:
-            cmd.append("--refresh")
-
-        # Use asyncio.create_subprocess_exec for non-blocking execution
-        # Run from root directory so all paths work correctly
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout, stderr = await process.communicate()
-        
-        if process.returncode != 0:
-            raise RuntimeError(f"Pipeline failed for doctor_id {doctor_id}: {stderr.decode().strip()}")
-            
+            pipeline_args.append("--refresh")
+
+        loop = asyncio.get_running_loop()
+        if PIPELINE_SUBPROCESS:
+            # Workers import run_pipeline_pq once and are reused across tasks
+            try:
+                await loop.run_in_executor(
+                    get_pipeline_pool(), run_pipeline_pq.run_from_argv, pipeline_args, request.patient_ids
+                )
+            except run_pipeline_pq.PipelineStepError as e:
+                raise run_pipeline_pq.PipelineStepError(f"Pipeline failed for doctor_id {doctor_id}: {e}", e.returncode)
+            except BrokenProcessPool:
+                # A worker died (e.g. OOM killed); start a fresh pool for the next task
+                reset_pipeline_pool()
+                raise run_pipeline_pq.PipelineStepError(f"Pipeline worker died for doctor_id {doctor_id}", None)
+        else:
+            # Run on a dedicated pipeline thread; cheapest to start, but the steps share the API process's GIL
+            args = run_pipeline_pq.build_parser().parse_args(pipeline_args)
+            try:
+                await loop.run_in_executor(get_pipeline_threads(), run_pipeline_pq.run, args, request.patient_ids)
+            except run_pipeline_pq.PipelineStepError as e:
+                raise run_pipeline_pq.PipelineStepError(f"Pipeline failed for doctor_id {doctor_id}: {e}", e.returncode)
+            except RuntimeError as e:
+                raise RuntimeError(f"Pipeline failed for doctor_id {doctor_id}: {e}")
+
         # Verify output files exist
         json_path = os.path.join(sub_task_dir, "matches_consolidated.json")
-        excel_path = os.path.join(sub_task_dir, "matches_scoring_consolidated.xlsx")
+        parquet_path = os.path.join(sub_task_dir, "matches_scoring_consolidated.parquet")
 
-        if not os.path.exists(json_path) or not os.path.exists(excel_path):
+        if not os.path.exists(json_path) or not os.path.exists(parquet_path):
              raise FileNotFoundError(f"Expected output files not found in {sub_task_dir}")
 
         # --- Cache the successful result ---
         set_cache(cache_key, {
-            "output_files": { "json": json_path, "excel": excel_path },
+            "output_files": { "json": json_path, "parquet": parquet_path },
             "cached_at": datetime.now().isoformat()
         }, ttl=7200) # Cache for 2 hours
 
@@ -218,88 +452,168 @@ async def run_single_pipeline_task(job_id: str, request: SingleRequest, refresh:
             "doctor_id": doctor_id,
             "status": "completed",
             "json_path": json_path,
-            "excel_path": excel_path,
+            "parquet_path": parquet_path,
             "error": None
         }
 
     except Exception as e:
+        # Only killed pipelines (including steps killed at PIPELINE_STEP_TIMEOUT) are worth retrying;
+        # bad inputs and missing files fail again
+        retryable = isinstance(e, run_pipeline_pq.PipelineStepError) and e.returncode in TRANSIENT_RETURN_CODES
         return {
             "doctor_id": doctor_id,
             "status": "failed",
-            "error": str(e)
+            "error": str(e),
+            "retryable": retryable
         }
-    finally:
-        if samples_file and os.path.exists(samples_file):
-            os.remove(samples_file)
+
+
+def read_file_bytes(path: str) -> bytes:
+    """Read a whole file as bytes."""
+    with open(path, 'rb') as f:
+        return f.read()
+
+def stat_or_none(path: str) -> Optional[os.stat_result]:
+    """Stat a file once for FileResponse, returning None if it no longer exists (e.g. swept)."""
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def extract_matches_array(data: bytes) -> bytes:
+    """
+    Returns the raw bytes inside the "matches" array of a pipeline JSON shard ({"matches": [...]})
+    without building Python objects. Falls back to orjson for shards with any other layout.
+    """
+    key_pos = data.find(b'"matches"')
+    start = data.find(b'[', key_pos)
+    end = data.rfind(b']')
+    if (key_pos != -1 and start != -1 and end > start
+            and data[:key_pos].strip() == b'{'
+            and data[key_pos + len(b'"matches"'):start].strip() == b':'
+            and data[end + 1:].strip() == b'}'):
+        return data[start + 1:end].strip()
+    # Unexpected layout: parse the shard and re-serialize only its matches
+    matches = orjson.loads(data).get("matches")
+    if not isinstance(matches, list):
+        return b''
+    return orjson.dumps(matches)[1:-1]
 
 
 def merge_json_results(tasks: List[Dict], final_dir: str, job_id: str) -> Optional[str]:
-    """Merges all successful JSON results into a single file."""
-    combined_data = {"matches": []}
+    """Merges all successful JSON results into a single file by concatenating their matches arrays at the byte level."""
     successful_tasks = [task for task in tasks if task["status"] in ["completed", "completed_from_cache"]]
     if not successful_tasks:
         return None
-        
-    for task in successful_tasks:
-        try:
-            with open(task["json_path"], 'r') as f:
-                data = json.load(f)
-            if "matches" in data and isinstance(data["matches"], list):
-                combined_data["matches"].extend(data["matches"])
-        except Exception as e:
-            logger.error(f"Error reading JSON for doctor_id {task['doctor_id']}: {e}")
 
     final_json_path = os.path.join(final_dir, f"combined_results_{job_id}.json")
-    with open(final_json_path, 'w') as f:
-        json.dump(combined_data, f, indent=4)
+    with open(final_json_path, 'wb') as out:
+        out.write(b'{"matches":[')
+        first = True
+        for task in successful_tasks:
+            try:
+                with open(task["json_path"], 'rb') as f:
+                    matches = extract_matches_array(f.read())
+            except Exception as e:
+                logger.error(f"Error reading JSON for doctor_id {task['doctor_id']}: {e}")
+                continue
+            if not matches:
+                continue
+            if not first:
+                out.write(b',')
+            out.write(matches)
+            first = False
+        out.write(b']}')
     return final_json_path
 
 
 def merge_excel_results(tasks: List[Dict], final_dir: str, job_id: str) -> Optional[str]:
-    """Merges all successful Excel results into a single file."""
-    all_dfs = []
+    """
+    Merges all successful results into a single Excel file. The per-doctor Parquet shards are
+    concatenated as Arrow tables and streamed into a constant-memory xlsxwriter workbook.
+    """
     successful_tasks = [task for task in tasks if task["status"] in ["completed", "completed_from_cache"]]
     if not successful_tasks:
         return None
 
+    tables = []
     for task in successful_tasks:
         try:
-            df = pd.read_excel(task["excel_path"])
-            all_dfs.append(df)
+            tables.append(pq.read_table(task["parquet_path"]))
         except Exception as e:
-            logger.error(f"Error reading Excel for doctor_id {task['doctor_id']}: {e}")
-            
-    if not all_dfs:
+            logger.error(f"Error reading Parquet for doctor_id {task['doctor_id']}: {e}")
+
+    if not tables:
         return None
 
-    combined_df = pd.concat(all_dfs, ignore_index=True)
+    # Columns missing from a shard are filled with nulls, like pd.concat
+    combined = pa.concat_tables(tables, promote_options="permissive")
     final_excel_path = os.path.join(final_dir, f"combined_results_{job_id}.xlsx")
-    combined_df.to_excel(final_excel_path, index=False)
+    output = xlsxwriter.Workbook(final_excel_path, {'constant_memory': True, 'strings_to_urls': False})
+    try:
+        worksheet = output.add_worksheet()
+        worksheet.write_row(0, 0, combined.column_names)
+        row_num = 1
+        for batch in combined.to_batches(max_chunksize=8192):
+            for values in zip(*(column.to_pylist() for column in batch.columns)):
+                worksheet.write_row(row_num, 0, values)
+                row_num += 1
+    finally:
+        output.close()
     return final_excel_path
 
 
 async def run_batch_pipeline_async(job_id: str, request: BatchPipelineRequest):
-    """The main background task to run and manage the batch processing, with a concurrent retry mechanism."""
-    job_data = get_job_status(job_id)
+    """The main background task. Waits for a free job slot (the job stays 'pending' meanwhile) before processing."""
+    async with JOB_SEMAPHORE:
+        await process_batch_pipeline(job_id, request)
+
+
+async def process_batch_pipeline(job_id: str, request: BatchPipelineRequest):
+    """Runs and manages the batch processing, with a concurrent retry mechanism."""
+    job_data = await get_job_status(job_id)
+    if job_data is None:
+        logger.info(f"Job {job_id} was deleted before it started; skipping.")
+        return
     job_data["status"] = "running"
     job_data["message"] = f"Processing {len(request.requests)} doctor lists..."
-    set_job_status(job_id, job_data)
+    await update_job_status(job_id, {"status": job_data["status"], "message": job_data["message"]})
     
+    # Bound the number of sub-tasks in flight so large batches don't oversubscribe the host
+    sem = asyncio.Semaphore(max(1, PIPELINE_CONCURRENCY))
+
+    # Hash each doctor's patient list once; the retry pass reuses the keys
+    cache_keys = {id(req): get_cache_key(req) for req in request.requests}
+
+    async def run_bounded(req: SingleRequest, check_cache: bool = True):
+        async with sem:
+            return await run_single_pipeline_task(
+                job_id, req, request.refresh, cache_key=cache_keys[id(req)], check_cache=check_cache
+            )
+
     # --- First Pass: Run all tasks concurrently ---
-    initial_coroutines = [run_single_pipeline_task(job_id, req, request.refresh) for req in request.requests]
+    initial_coroutines = [run_bounded(req) for req in request.requests]
     logger.info(f"Starting initial concurrent run for {len(initial_coroutines)} sub-tasks.")
     initial_results = await asyncio.gather(*initial_coroutines)
     
     # Identify successful and failed tasks from the first pass
     successful_on_first_pass = [res for res in initial_results if res["status"] in ["completed", "completed_from_cache"]]
-    failed_requests = [req for req, res in zip(request.requests, initial_results) if res["status"] == "failed"]
+    failed_requests = [
+        req for req, res in zip(request.requests, initial_results)
+        if res["status"] == "failed" and res.get("retryable")
+    ]
     
-    final_results = successful_on_first_pass
+    # Deterministic failures are kept as-is instead of being re-run
+    final_results = successful_on_first_pass + [
+        res for res in initial_results if res["status"] == "failed" and not res.get("retryable")
+    ]
 
-    # --- Retry Pass: Concurrently re-run only the failed tasks ---
+    # --- Retry Pass: Concurrently re-run only the transiently failed tasks ---
     if failed_requests:
-        logger.warning(f"Initial run failed for {len(failed_requests)} sub-tasks. Starting concurrent retry pass.")
-        retry_coroutines = [run_single_pipeline_task(job_id, req, request.refresh) for req in failed_requests]
+        logger.warning(f"Initial run failed transiently for {len(failed_requests)} sub-tasks. Starting concurrent retry pass.")
+        # These requests missed the cache moments ago in the first pass, so skip the lookup
+        retry_coroutines = [run_bounded(req, check_cache=False) for req in failed_requests]
         retry_results = await asyncio.gather(*retry_coroutines)
         
         # Combine the successful results from the first pass with the results of the retry pass
@@ -313,12 +627,13 @@ async def run_batch_pipeline_async(job_id: str, request: BatchPipelineRequest):
     job_data["doctor_ids_failed"] = sorted(list(set(task["doctor_id"] for task in failed_tasks)))
     job_data["errors"] = [{"doctor_id": task["doctor_id"], "error": task["error"]} for task in failed_tasks]
 
-    final_output_dir = os.path.join(os.getcwd(), "api_outputs", job_id, "final")
+    final_output_dir = os.path.join(API_OUTPUTS_DIR, job_id, "final")
     os.makedirs(final_output_dir, exist_ok=True)
     
-    # Merge results with exception handling to prevent jobs from getting stuck
+    # Merge results with exception handling to prevent jobs from getting stuck.
+    # File merging runs on a worker thread so status polls are not blocked meanwhile.
     try:
-        final_json = merge_json_results(successful_tasks, final_output_dir, job_id)
+        final_json = await asyncio.to_thread(merge_json_results, successful_tasks, final_output_dir, job_id)
     except Exception as e:
         logger.error(f"Error merging JSON results for job {job_id}: {e}")
         final_json = None
@@ -327,42 +642,159 @@ async def run_batch_pipeline_async(job_id: str, request: BatchPipelineRequest):
             "error": f"Failed to merge JSON results: {str(e)}"
         })
     
-    try:
-        final_excel = merge_excel_results(successful_tasks, final_output_dir, job_id)
-    except Exception as e:
-        logger.error(f"Error merging Excel results for job {job_id}: {e}")
-        final_excel = None
-        job_data["errors"].append({
-            "doctor_id": None,
-            "error": f"Failed to merge Excel results: {str(e)}"
-        })
+    # The Excel workbook is built lazily on the first download; keep the Parquet shards it needs
+    # outside the sub-task directories, which are removed below
+    shards_dir = os.path.join(final_output_dir, "shards")
+    os.makedirs(shards_dir, exist_ok=True)
+    pending_excel_shards = []
+    for task in successful_tasks:
+        shard_path = os.path.join(shards_dir, f"{task['doctor_id']}.parquet")
+        try:
+            if task["status"] == "completed":
+                shutil.move(task["parquet_path"], shard_path)
+            else:
+                shutil.copyfile(task["parquet_path"], shard_path)
+            pending_excel_shards.append(shard_path)
+        except OSError as e:
+            logger.error(f"Failed to keep Parquet shard for doctor_id {task['doctor_id']}: {e}")
     
-    if final_json and final_excel:
+    if final_json:
         job_data["status"] = "completed"
         job_data["message"] = f"Processed {len(successful_tasks)} of {len(request.requests)} lists successfully."
-        job_data["output_files"] = {"json": final_json, "excel": final_excel}
+        job_data["output_files"] = {"json": final_json}
+        job_data["pending_excel_shards"] = pending_excel_shards
+        try:
+            await store_results_bytes(job_id, await asyncio.to_thread(read_file_bytes, final_json))
+        except Exception as e:
+            logger.warning(f"Could not cache JSON results for job {job_id}: {e}")
     else:
         job_data["status"] = "failed"
         error_summary = []
         if not final_json:
             error_summary.append("JSON merge failed")
-        if not final_excel:
-            error_summary.append("Excel merge failed")
         if not successful_tasks:
             error_summary.append("No successful tasks")
         job_data["message"] = f"Batch processing failed: {', '.join(error_summary)}."
 
     job_data["completed_at"] = datetime.now().isoformat()
-    set_job_status(job_id, job_data)
-    
-    # Optional: Clean up intermediate sub-task directories
-    for res in final_results: # Use final_results here
-        sub_task_dir = os.path.join(os.getcwd(), "api_outputs", job_id, str(res["doctor_id"]))
+    if not await update_job_status(job_id, job_data):
+        logger.info(f"Job {job_id} was deleted while running; its final status was not recorded.")
+    
+    # Optional: Clean up intermediate sub-task directories, deleting them in parallel worker threads
+    sub_task_dirs = [os.path.join(API_OUTPUTS_DIR, job_id, str(res["doctor_id"])) for res in final_results]
+    cleanup_results = await asyncio.gather(
+        *(asyncio.to_thread(shutil.rmtree, sub_task_dir) for sub_task_dir in sub_task_dirs),
+        return_exceptions=True
+    )
+    for sub_task_dir, result in zip(sub_task_dirs, cleanup_results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to clean up sub-task directory {sub_task_dir}: {result}")
+
+
+async def ensure_excel(job_id: str) -> Optional[str]:
+    """
+    Builds the combined Excel file of a completed job on first request and records it in the
+    job's output_files. Concurrent callers for the same job wait on a shared lock.
+    """
+    lock = excel_locks.setdefault(job_id, asyncio.Lock())
+    async with lock:
+        job_data = await get_job_status(job_id)
+        if not job_data:
+            return None
+        excel_path = job_data.get("output_files", {}).get("excel")
+        if excel_path and os.path.exists(excel_path):
+            return excel_path
+
+        shards = job_data.get("pending_excel_shards") or []
+        tasks = [
+            {"doctor_id": os.path.splitext(os.path.basename(path))[0], "status": "completed", "parquet_path": path}
+            for path in shards if os.path.exists(path)
+        ]
+        final_output_dir = os.path.join(API_OUTPUTS_DIR, job_id, "final")
+        excel_path = await asyncio.to_thread(merge_excel_results, tasks, final_output_dir, job_id)
+        if not excel_path:
+            return None
+
+        job_data["output_files"]["excel"] = excel_path
+        await update_job_status(job_id, {
+            "output_files": job_data["output_files"],
+            "pending_excel_shards": None,
+        })
+        shutil.rmtree(os.path.join(final_output_dir, "shards"), ignore_errors=True)
+        return excel_path
+
+
+# --- Application Lifecycle ---
+
+@app.on_event("startup")
+async def connect_redis():
+    """Connect to Redis for job status storage if REDIS_URL is configured."""
+    global redis_client
+    if not REDIS_URL:
+        logger.info("REDIS_URL not set; storing job status in memory.")
+        return
+    if aioredis is None:
+        logger.warning("REDIS_URL is set but the redis package is not installed; storing job status in memory.")
+        return
+    # Values are orjson bytes, so responses are left undecoded. One bounded pool of keep-alive
+    # connections is shared by every request and background job; callers wait for a free connection when it is exhausted.
+    pool = aioredis.BlockingConnectionPool.from_url(REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS, socket_keepalive=True)
+    redis_client = aioredis.Redis(connection_pool=pool)
+    await redis_client.ping()
+    logger.info("Connected to Redis for job status storage.")
+
+@app.on_event("shutdown")
+async def close_redis():
+    """Close the Redis connection on shutdown."""
+    if redis_client is not None:
+        await redis_client.aclose()
+        await redis_client.connection_pool.disconnect()
+
+async def sweep_outputs():
+    """Periodically remove api_outputs/{job_id} directories of expired or deleted jobs."""
+    while True:
+        await asyncio.sleep(OUTPUTS_SWEEP_INTERVAL)
         try:
-            shutil.rmtree(sub_task_dir)
+            cutoff = time.time() - OUTPUTS_TTL
+            with os.scandir(API_OUTPUTS_DIR) as entries:
+                stale = [entry for entry in entries if entry.is_dir() and entry.stat().st_mtime < cutoff]
+            for entry in stale:
+                if await get_job_status(entry.name) is None:
+                    # The job is gone, so nothing can still be waiting on its Excel build lock
+                    excel_locks.pop(entry.name, None)
+                    await asyncio.to_thread(shutil.rmtree, entry.path, ignore_errors=True)
+                    logger.info(f"Removed outputs of expired job {entry.name}")
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            logger.error(f"Failed to clean up sub-task directory {sub_task_dir}: {e}")
-
+            logger.error(f"Error sweeping {API_OUTPUTS_DIR}: {e}")
+
+@app.on_event("startup")
+async def start_outputs_sweeper():
+    """Start the background sweep of old job output directories."""
+    global outputs_sweeper
+    outputs_sweeper = asyncio.create_task(sweep_outputs())
+
+@app.on_event("shutdown")
+async def stop_outputs_sweeper():
+    """Stop the background sweep of old job output directories."""
+    if outputs_sweeper is not None:
+        outputs_sweeper.cancel()
+
+@app.on_event("startup")
+async def start_pipeline_pool():
+    """Start the pipeline worker processes up front when PIPELINE_SUBPROCESS is enabled."""
+    if PIPELINE_SUBPROCESS:
+        get_pipeline_pool()
+
+@app.on_event("shutdown")
+async def stop_pipeline_pool():
+    """Stop the pipeline worker processes and threads on shutdown."""
+    global pipeline_threads
+    reset_pipeline_pool()
+    if pipeline_threads is not None:
+        pipeline_threads.shutdown(wait=False, cancel_futures=True)
+        pipeline_threads = None
 
 # --- API Endpoints ---
 
@@ -382,7 +814,7 @@ async def health_check():
         "timestamp": datetime.now().isoformat(),
     }
 
-@app.post("/process")
+@app.post("/process", status_code=202)
 async def process_patients_batch(
     request: BatchPipelineRequest,
     background_tasks: BackgroundTasks,
@@ -407,22 +839,30 @@ async def process_patients_batch(
         "errors": [],
         "output_files": None
     }
-    set_job_status(job_id, initial_job_data)
+    await set_job_status(job_id, initial_job_data)
     
     background_tasks.add_task(run_batch_pipeline_async, job_id, request)
     
-    return { "job_id": job_id, "message": "Batch job started.", "status": "pending" }
+    # 202 Accepted: the job runs in the background; clients poll the Location for progress
+    return JSONResponse(
+        status_code=202,
+        content={ "job_id": job_id, "message": "Batch job started.", "status": "pending" },
+        headers={"Location": f"/status/{job_id}"}
+    )
 
 
 @app.get("/status/{job_id}", response_model=JobStatusResponse)
 async def get_job_status_endpoint(job_id: str, api_key: str = Depends(verify_api_key)):
     """Get the simplified status of a batch job."""
-    job_data = get_job_status(job_id)
+    job_data = await get_job_status(job_id)
     if not job_data:
         raise HTTPException(status_code=404, detail="Job not found")
     
-    # Map the internal, detailed status to the simplified public response
-    return JobStatusResponse(**job_data)
+    # Map the internal, detailed status to the simplified public response, serialized once in pydantic-core
+    return Response(
+        content=JobStatusResponse.model_validate(job_data).model_dump_json(),
+        media_type="application/json"
+    )
 
 @app.get("/job/{job_id}/details")
 async def get_job_details_debug(job_id: str, api_key: str = Depends(verify_api_key)):
@@ -430,7 +870,7 @@ async def get_job_details_debug(job_id: str, api_key: str = Depends(verify_api_k
     (DEBUGGING) Returns the full internal state of a job, including detailed
     error messages for each failed sub-task.
     """
-    job_data = get_job_status(job_id)
+    job_data = await get_job_status(job_id)
     if not job_data:
         raise HTTPException(status_code=404, detail="Job not found")
     return job_data
@@ -438,7 +878,7 @@ async def get_job_details_debug(job_id: str, api_key: str = Depends(verify_api_k
 @app.get("/download/{job_id}/{format}")
 async def download_results(job_id: str, format: str, api_key: str = Depends(verify_api_key)):
     """Download results in specified format (json or excel)"""
-    job_data = get_job_status(job_id)
+    job_data = await get_job_status(job_id)
     if not job_data:
         raise HTTPException(status_code=404, detail="Job not found")
     
@@ -452,16 +892,24 @@ async def download_results(job_id: str, format: str, api_key: str = Depends(veri
         raise HTTPException(status_code=400, detail="Format must be 'json' or 'excel'")
     
     file_path = job_data["output_files"].get(format)
-    if not file_path or not os.path.exists(file_path):
+    if format == "excel" and not file_path:
+        try:
+            file_path = await ensure_excel(job_id)
+        except Exception as e:
+            logger.error(f"Error merging Excel results for job {job_id}: {e}")
+            raise HTTPException(status_code=500, detail="Failed to build Excel file")
+    # One stat serves as the existence check and is handed to FileResponse so it does not stat the file again
+    stat_result = stat_or_none(file_path) if file_path else None
+    if stat_result is None:
         raise HTTPException(status_code=404, detail=f"{format.upper()} file not found")
     
     filename = f"results_{job_id}.{format if format != 'excel' else 'xlsx'}"
-    return FileResponse(file_path, filename=filename)
+    return FileResponse(file_path, filename=filename, stat_result=stat_result)
 
 @app.get("/results/{job_id}")
 async def get_results_json(job_id: str, api_key: str = Depends(verify_api_key)):
     """Get results in JSON format directly. The doctor_id is now part of the source file."""
-    job_data = get_job_status(job_id)
+    job_data = await get_job_status(job_id)
     if not job_data:
         raise HTTPException(status_code=404, detail="Job not found")
     
@@ -472,6 +920,11 @@ async def get_results_json(job_id: str, api_key: str = Depends(verify_api_key)):
     
     # The inject_doctor_id function is no longer needed as the ID comes from the source file.
 
+    # Serve the memoized bytes of the combined results file when available
+    results_bytes = await fetch_results_bytes(job_id)
+    if results_bytes is not None:
+        return Response(content=results_bytes, media_type="application/json")
+
     # Check cache first
     cache_key = job_data.get("cache_key")
     if cache_key:
@@ -497,31 +950,28 @@ async def get_results_json(job_id: str, api_key: str = Depends(verify_api_key)):
         
         return { "error": "No JSON results file found", "debug_info": { "job_data": job_data, "cache_key": cache_key, "available_files": output_files } }
     
-    if not os.path.exists(json_file):
+    stat_result = stat_or_none(json_file)
+    if stat_result is None:
         logger.error(f"JSON file {json_file} does not exist for job {job_id}")
         raise HTTPException(status_code=404, detail=f"JSON file not found: {json_file}")
     
-    try:
-        with open(json_file, 'r') as f:
-            results = json.load(f)
-        logger.info(f"Successfully read JSON file for job {job_id}, size: {len(str(results))} chars")
-        if not results:
-            logger.warning(f"JSON file is empty for job {job_id}")
-        return results
-    except Exception as e:
-        logger.error(f"Error reading JSON file {json_file} for job {job_id}: {e}")
-        raise HTTPException(status_code=500, detail=f"Error reading results: {str(e)}")
+    # Not memoized in this process: stream the file as-is, letting Starlette use sendfile where available
+    return FileResponse(json_file, media_type="application/json", stat_result=stat_result)
 
 @app.delete("/job/{job_id}")
 async def delete_job(job_id: str, api_key: str = Depends(verify_api_key)):
     """Delete a job and its status"""
-    job_data = get_job_status(job_id)
+    job_data = await get_job_status(job_id)
     if not job_data:
         raise HTTPException(status_code=404, detail="Job not found")
     
-    # Delete from Redis or memory
-    if job_id in job_status_memory:
-        del job_status_memory[job_id]
+    # Delete from Redis or memory; with Redis, the status and results keys go in one DEL
+    if redis_client is not None:
+        await redis_client.delete(get_job_key(job_id), get_results_key(job_id))
+    else:
+        await delete_job_status(job_id)
+    results_bytes_cache.pop(job_id, None)
+    excel_locks.pop(job_id, None)
     
     return {"message": f"Job {job_id} deleted successfully"}
 
@@ -537,8 +987,9 @@ async def cache_stats(api_key: str = Depends(verify_api_key)):
     """Get in-memory cache statistics."""
     return {
         "caching_backend": "in_memory",
+        "job_status_backend": "redis" if redis_client is not None else "in_memory",
         "memory_cache_size": len(cache_memory),
-        "job_status_size": len(job_status_memory)
+        "job_status_size": await count_job_statuses()
     }
 
 if __name__ == "__main__":
@@ -3,44 +3,63 @@ import argparse
 import sys
 import os
 import hashlib
-import json
+import orjson
 import tempfile
 import shutil
+from collections import deque
+import traceback
+from datetime import datetime
+
+try:
+    from src import workbench_retrieval, ecrf_extract_pq, twin_algo_pq
+except ImportError:  # Executed directly as `python src/run_pipeline_pq.py`
+    import workbench_retrieval
+    import ecrf_extract_pq
+    import twin_algo_pq
+
+# Set PIPELINE_STEP_SUBPROCESS=1 to run each step in its own interpreter instead of in-process
+PIPELINE_STEP_SUBPROCESS = os.getenv("PIPELINE_STEP_SUBPROCESS", "0") == "1"
+# Seconds a spawned step may run before it is killed; in-process steps cannot be interrupted and have no limit
+PIPELINE_STEP_TIMEOUT = float(os.getenv("PIPELINE_STEP_TIMEOUT", "7200"))
 
 
 def get_file_hash(filepath):
-    """Calculate MD5 hash of a file"""
+    """Calculate a BLAKE2b hash of a file, used only for change detection"""
     if not os.path.exists(filepath): return None
-    hash_md5 = hashlib.md5()
     with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+        # file_digest reads into a reusable buffer instead of allocating a bytes object per 4 KB chunk
+        return hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
 
 def check_previous_run(samples_file, work_dir):
     """Check for a state file within the working directory."""
-    state_file = os.path.join(work_dir, "pipeline_state.json")
-    if not os.path.exists(state_file):
+    # List the directory once instead of stat-ing each expected file
+    try:
+        with os.scandir(work_dir) as entries:
+            present = {entry.name for entry in entries}
+    except FileNotFoundError:
         return False, False, None
+    if "pipeline_state.json" not in present:
+        return False, False, None
+    state_file = os.path.join(work_dir, "pipeline_state.json")
     
     try:
-        with open(state_file, 'r') as f:
-            state = json.load(f)
+        with open(state_file, 'rb') as f:
+            state = orjson.loads(f.read())
         
         current_hash = get_file_hash(samples_file)
         if state.get('samples_hash') != current_hash:
             return False, False, state
         
-        genomic_files_exist = all(os.path.exists(os.path.join(work_dir, f)) for f in [
+        genomic_files_exist = {
             "snv_cdss_input.parquet", "cnv_cdss_input.parquet", 
             "fusion_cdss_input.parquet", "retrieved_list.txt"
-        ])
+        }.issubset(present)
         
-        clinical_files_exist = os.path.exists(os.path.join(work_dir, "clinical_Details.parquet"))
+        clinical_files_exist = "clinical_Details.parquet" in present
         
         return genomic_files_exist, clinical_files_exist, state
         
-    except (json.JSONDecodeError, FileNotFoundError):
+    except (orjson.JSONDecodeError, FileNotFoundError):
         return False, False, None
 
 def save_pipeline_state(samples_file, work_dir):
@@ -50,29 +69,94 @@ def save_pipeline_state(samples_file, work_dir):
         'samples_file': os.path.basename(samples_file),
         'timestamp': datetime.fromtimestamp(os.path.getmtime(samples_file)).isoformat()
     }
-    with open(os.path.join(work_dir, "pipeline_state.json"), 'w') as f:
-        json.dump(state, f, indent=2)
+    with open(os.path.join(work_dir, "pipeline_state.json"), 'wb') as f:
+        f.write(orjson.dumps(state, option=orjson.OPT_INDENT_2))
+
+# Only the last lines of each child stream are printed on failure
+OUTPUT_TAIL_LINES = 1024
+
+class PipelineStepError(RuntimeError):
+    """Raised when a pipeline step exits non-zero; keeps the step's return code."""
+    def __init__(self, message, returncode=None):
+        super().__init__(message)
+        self.returncode = returncode
+
+    def __reduce__(self):
+        # Keep the return code when the error crosses a process boundary
+        return (self.__class__, (str(self), self.returncode))
+
+def _read_tail(f):
+    """Return the last OUTPUT_TAIL_LINES lines of a spooled child output file."""
+    f.seek(0)
+    return b"".join(deque(f, maxlen=OUTPUT_TAIL_LINES)).decode(errors="replace")
 
 def run_command(cmd, description):
-    """Run a command and handle errors"""
+    """
+    Run a command and handle errors.
+    Returns (returncode, detail): 0 on success, otherwise the command's return code and the tail of its stderr.
+    """
     print(f'\n{description}...')
     print(f'Running: {" ".join(cmd)}')
-    try:
+    # The child writes straight to anonymous temp files, so its output is never buffered in this process
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
         # Using sys.executable ensures we use the same python interpreter
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True, env=os.environ)
-        print(f'{description} completed successfully.')
-        return True
-    except subprocess.CalledProcessError as e:
+        try:
+            returncode = subprocess.run(cmd, stdout=out, stderr=err, timeout=PIPELINE_STEP_TIMEOUT).returncode
+        except subprocess.TimeoutExpired:
+            # subprocess.run has already killed and reaped the child; report it like any SIGKILL
+            print(f'{description} timed out after {PIPELINE_STEP_TIMEOUT:.0f}s and was killed.')
+            returncode = -9
+
+        if returncode != 0:
+            print(f'Error in {description}:')
+            print(f'Return code: {returncode}')
+            print(f'stdout: {_read_tail(out).strip()}')
+            detail = _read_tail(err).strip()
+            print(f'stderr: {detail}')
+            return returncode, detail
+    print(f'{description} completed successfully.')
+    return 0, ''
+
+def _step_failure(message, detail):
+    """Append a failed step's error detail (exception or stderr tail) to a pipeline failure message."""
+    return f"{message} {detail}" if detail else message
+
+def run_step(module, argv, description):
+    """
+    Run a pipeline step module (exposing build_parser/run) with the given arguments.
+    Returns (returncode, detail) like run_command, where detail describes the failure.
+    Steps run in-process so pandas/polars and the step modules are imported once; sys.exit calls are turned
+    into return codes. With PIPELINE_STEP_SUBPROCESS=1 the step's script is spawned instead.
+    """
+    if PIPELINE_STEP_SUBPROCESS:
+        return run_command([sys.executable, module.__file__, *argv], description)
+
+    print(f'\n{description}...')
+    detail = ''
+    try:
+        module.run(module.build_parser().parse_args(argv))
+        returncode = 0
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        if not isinstance(e.code, int) and e.code is not None:
+            detail = str(e.code)
+    except Exception as e:
+        traceback.print_exc()
+        returncode = 1
+        detail = "".join(traceback.format_exception_only(type(e), e)).strip()
+
+    if returncode != 0:
         print(f'Error in {description}:')
-        print(f'Return code: {e.returncode}')
-        print(f'stdout: {e.stdout.strip()}')
-        print(f'stderr: {e.stderr.strip()}')
-        return False
+        print(f'Return code: {returncode}')
+        return returncode, detail
+    print(f'{description} completed successfully.')
+    return 0, ''
 
-def main():
+def build_parser():
+    """Build the argument parser shared by the CLI and in-process callers."""
     parser = argparse.ArgumentParser(description='Run the full onco-twin pipeline with Parquet files')
     
-    parser.add_argument('--samples', type=str, required=True, help='Path to .txt file containing list of sample IDs')
+    parser.add_argument('--samples', type=str, required=True, help='Path to .txt file containing list of sample IDs, or - to read them from stdin')
     parser.add_argument('--output_dir', type=str, default='output', help='Directory to save final results.')
     parser.add_argument('--keep_temp_dir', action='store_true', help='Keep the temporary directory after the run for debugging.')
     
@@ -88,9 +172,35 @@ def main():
     parser.add_argument('--skip_clinical', action='store_true', help='Skip clinical data extraction')
     parser.add_argument('--skip_matching', action='store_true', help='Skip matching algorithm')
     parser.add_argument('--refresh', action='store_true', help='Force refresh of data')
-    
-    args = parser.parse_args()
-    
+    return parser
+
+def materialize_samples(samples, work_dir, sample_ids=None):
+    """
+    Resolve the --samples argument to a file path the component scripts can read.
+    For '-' the IDs come from sample_ids (in-process callers) or stdin, and are
+    written once into the run's working directory so no caller-side temp file is needed.
+    """
+    if samples != '-':
+        return samples
+    if sample_ids is None:
+        sample_ids = [line.strip() for line in sys.stdin if line.strip()]
+    samples_file = os.path.join(work_dir, 'samples.txt')
+    # Raw fd write: the payload is built in one buffer, so Python's file object layer adds nothing
+    data = memoryview(("\n".join(sample_ids) + "\n").encode())
+    fd = os.open(samples_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+    return samples_file
+
+def run(args, sample_ids=None):
+    """
+    Run the pipeline for an already-parsed argument namespace.
+    Raises RuntimeError if any step fails, so it can be called in-process.
+    With --samples -, the IDs are taken from sample_ids if given, otherwise from stdin.
+    """
     # Create a temporary directory for the entire pipeline run
     work_dir = tempfile.mkdtemp(prefix="oncotwin_run_")
     print(f"Pipeline working directory: {work_dir}")
@@ -101,50 +211,51 @@ def main():
     print(f"Final output will be in: {final_output_dir}")
 
     try:
-        can_skip_genomic, can_skip_clinical, _ = check_previous_run(args.samples, work_dir)
+        samples_file = materialize_samples(args.samples, work_dir, sample_ids)
+        can_skip_genomic, can_skip_clinical, _ = check_previous_run(samples_file, work_dir)
         
         skip_genomic = (can_skip_genomic and not args.refresh) or args.skip_genomic
         skip_clinical = (can_skip_clinical and not args.refresh) or args.skip_clinical
 
         # Step 1: Genomic data retrieval
         if not skip_genomic:
-            cmd = [sys.executable, 'src/workbench_retrieval.py', '--samples', args.samples, '--output_dir', work_dir]
-            if not run_command(cmd, "Genomic data retrieval"):
-                print("Pipeline failed at genomic data retrieval.")
-                sys.exit(1)
-            save_pipeline_state(args.samples, work_dir)
+            step_args = ['--samples', samples_file, '--output_dir', work_dir]
+            returncode, detail = run_step(workbench_retrieval, step_args, "Genomic data retrieval")
+            if returncode != 0:
+                raise PipelineStepError(_step_failure("Pipeline failed at genomic data retrieval.", detail), returncode)
+            save_pipeline_state(samples_file, work_dir)
         else:
             print("Skipping genomic data retrieval.")
         
         # Step 2: Clinical data extraction
         if not skip_clinical:
-            # Note: ecrf_extract_pq.py now reads from and writes to the working directory
-            cmd = [sys.executable, 'src/ecrf_extract_pq.py', '--input_dir', work_dir, '--output_dir', work_dir]
-            if not run_command(cmd, "Clinical data extraction"):
-                print("Pipeline failed at clinical data extraction.")
-                sys.exit(1)
+            # Note: ecrf_extract_pq now reads from and writes to the working directory
+            step_args = ['--input_dir', work_dir, '--output_dir', work_dir]
+            returncode, detail = run_step(ecrf_extract_pq, step_args, "Clinical data extraction")
+            if returncode != 0:
+                raise PipelineStepError(_step_failure("Pipeline failed at clinical data extraction.", detail), returncode)
         else:
             print("Skipping clinical data extraction.")
         
         # Step 3: Matching algorithm
         if not args.skip_matching:
             # The matching script reads all inputs from work_dir and writes final output to final_output_dir
-            cmd = [sys.executable, 'src/twin_algo_pq.py', '--input_dir', work_dir, '--output_dir', final_output_dir]
+            step_args = ['--input_dir', work_dir, '--output_dir', final_output_dir]
             if args.single:
-                cmd.extend(['--single', args.single])
+                step_args.extend(['--single', args.single])
             if args.json_output:
-                cmd.append('--json_output')
+                step_args.append('--json_output')
             # Pass down the config file paths if they are provided
             if args.weights:
-                cmd.extend(['--weights', args.weights])
+                step_args.extend(['--weights', args.weights])
             if args.subsets:
-                cmd.extend(['--subsets', args.subsets])
+                step_args.extend(['--subsets', args.subsets])
             if args.doctor_id is not None:
-                cmd.extend(['--doctor_id', str(args.doctor_id)])
+                step_args.extend(['--doctor_id', str(args.doctor_id)])
             
-            if not run_command(cmd, "Patient matching"):
-                print("Pipeline failed at patient matching.")
-                sys.exit(1)
+            returncode, detail = run_step(twin_algo_pq, step_args, "Patient matching")
+            if returncode != 0:
+                raise PipelineStepError(_step_failure("Pipeline failed at patient matching.", detail), returncode)
         else:
             print("Skipping patient matching.")
         
@@ -159,7 +270,17 @@ def main():
         else:
             print(f"Temporary directory kept for inspection: {work_dir}")
 
+def run_from_argv(argv, sample_ids=None):
+    """Parse argv and run the pipeline; the entry point used by long-lived worker processes."""
+    run(build_parser().parse_args(argv), sample_ids)
+
+def main():
+    args = build_parser().parse_args()
+    try:
+        run(args)
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+
 if __name__ == "__main__":
-    # Import datetime for state saving
-    from datetime import datetime
-    main() 
\ No newline at end of file
+    main()
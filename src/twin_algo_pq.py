@@ -1,24 +1,43 @@
 import os
+import sys
 import pandas as pd
-import json
+import orjson
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 from collections import defaultdict
 from tqdm import tqdm
 import argparse
+import xlsxwriter
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; packed bitsets are then intersected with NumPy
+    njit = None
+
+# Profiles and match results may carry NumPy scalars straight from the input frames
+JSON_DUMP_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
 
 
 ## Basic Preprocessing
 def preprocess_dataframe(df):
     df.columns = df.columns.astype(str).str.strip().str.replace('\n', '') 
+    # Values are stringified by pandas (keeping its 'nan'/'1.0' formatting), then trimmed and cleaned by Arrow kernels
+    missing = pa.array(['nan', 'NA'])
+    cleaned = {}
     for column in df.columns:
-        df[column] = df[column].astype(str).str.strip().str.replace('\n', '')
-        df[column] = df[column].replace(['nan', 'NA'], [np.nan, np.nan])
+        values = pa.array(df[column].astype(str).to_numpy(dtype=object), type=pa.string(), from_pandas=True)
+        values = pc.replace_substring(pc.utf8_trim_whitespace(values), '\n', '')
+        cleaned[column] = pc.if_else(pc.is_in(values, value_set=missing), None, values)
 
-    return df
+    result = pa.table(cleaned).to_pandas()
+    result.index = df.index
+    return result
 
 ## Creating Patient Profiles
 def create_patient_profiles(snv_df, cnv_df, fusion_df, clinical_df, 
-                            snv_subset, cnv_subset, fusion_subset, clinical_subset, output_path):
+                            snv_subset, cnv_subset, fusion_subset, clinical_subset):
 
     # Define subsets dynamically
     subsets = {
@@ -28,46 +47,48 @@ def create_patient_profiles(snv_df, cnv_df, fusion_df, clinical_df,
         'clinical': {'df': clinical_df, 'cols': clinical_subset},
     }
 
-    os.makedirs(output_path, exist_ok=True)
-
-    # Fields with prefixes
-    all_fields = set()
+    # Fields with prefixes, in subset/column order so every profile lists them the same way
+    all_fields = []
     for subset_name, subset_info in subsets.items():
         prefixed_fields = [f"{subset_name}_{col}" for col in subset_info['cols'] if col != 'patientID']
-        all_fields.update(prefixed_fields)
+        all_fields.extend(field for field in prefixed_fields if field not in all_fields)
 
-    patient_profiles = defaultdict(lambda: defaultdict(set))
+    # field -> {patient_id: set of values}, patients kept in order of their first non-empty row
+    patient_order = {}
+    field_values = defaultdict(dict)
 
     for subset_name, subset_info in subsets.items():
         df = subset_info['df']
         cols = subset_info['cols']
-
-        # Relevant columns are selected
-        filtered_df = df[cols]
-
-        for _, row in filtered_df.iterrows():
-            patient_id = row['patientID']
-            data_entry = row.drop('patientID').to_dict()
-
-            for key, value in data_entry.items():
-                if pd.notna(value):  # Ignore NaN values
-                    prefixed_key = f"{subset_name}_{key}"
-                    patient_profiles[patient_id][prefixed_key].add(value)
-
-    # Ensure all fields are present in every patient profile
-    for patient_id, profile in patient_profiles.items():
-        for field in all_fields:
-            if field not in profile:
-                profile[field] = set()  # Keep it empty instead of NaN
+        value_cols = [col for col in cols if col != 'patientID']
+
+        # Relevant columns are selected, rows without any value contribute nothing
+        filtered_df = df[cols].dropna(how='all', subset=value_cols)
+        patient_order.update(dict.fromkeys(filtered_df['patientID'].dropna().unique()))
+
+        for col in value_cols:
+            # Ignore NaN values, collect the rest per patient
+            grouped = filtered_df.dropna(subset=[col]).groupby('patientID', sort=False)[col].agg(set)
+            values_by_patient = field_values[f"{subset_name}_{col}"]
+            for patient_id, values in grouped.items():
+                values_by_patient.setdefault(patient_id, set()).update(values)
+
+    # Ensure all fields are present in every patient profile, empty instead of NaN
+    patient_profiles = {
+        patient_id: {field: field_values[field].get(patient_id, set()) for field in all_fields}
+        for patient_id in patient_order
+    }
     # Convert sets to lists for JSON serialization (create a new dict)
     patient_profiles_list = {pid: {key: list(values) for key, values in profile.items()} for pid, profile in patient_profiles.items()}
+    return patient_profiles_list
 
+def save_patient_profiles(patient_profiles, output_path):
     # Write each patient profile to a JSON file
-    for patient_id, profile in patient_profiles_list.items():
+    os.makedirs(output_path, exist_ok=True)
+    for patient_id, profile in patient_profiles.items():
         filename = os.path.join(output_path, f"{patient_id}.json")
-        with open(filename, 'w') as json_file:
-            json.dump(profile, json_file, indent=4)
-    return patient_profiles_list
+        with open(filename, 'wb') as json_file:
+            json_file.write(orjson.dumps(profile, option=JSON_DUMP_OPTIONS))
             
                         
 def jaccard_similarity(set1, set2):
@@ -88,95 +109,312 @@ def jaccard_similarity(set1, set2):
     return intersection / union if union != 0 else 0
 
 
+# Fusion fields are compared against the other patient's gene3 and gene5 values combined
+FUSION_PARTNERS = {"fusion_gene3": "fusion_gene5", "fusion_gene5": "fusion_gene3"}
+
+def _numeric_summary(values):
+    """
+    Returns (sum, max) of the values converted to int, as used by jaccard_similarity's numeric branch,
+    or None when any value is not numeric.
+    """
+    try:
+        num_set = {int(x) for x in values}
+    except ValueError:
+        return None
+    return sum(num_set), max(num_set, default=0)
+
+# Query patients scored per matmul block, bounding the (block, N) score matrices held in memory
+SIMILARITY_BLOCK_SIZE = 256
+# Threads scoring blocks concurrently; NumPy releases the GIL inside matmul and the elementwise passes.
+# Standalone runs use every core; the API sets a per-pipeline share since it runs several pipelines at once
+TWIN_MATCH_WORKERS = int(os.getenv("TWIN_MATCH_WORKERS", str(os.cpu_count() or 1)))
+# Without numba, fields whose dense float32 presence matrix would exceed this many bytes are stored as packed uint64 bitsets
+DENSE_FIELD_MAX_BYTES = 256 * 1024 * 1024
+# Upper bound on the (rows, N, words) temporaries of the bitset intersection
+BITSET_CHUNK_BYTES = 32 * 1024 * 1024
+
+if hasattr(np, "bitwise_count"):  # NumPy >= 2.0
+    _popcount = np.bitwise_count
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(words):
+        return _POPCOUNT_TABLE[words.view(np.uint8)].reshape(*words.shape, 8).sum(axis=-1)
+
+if njit is not None:
+    # Typed constants keep the SWAR popcount in uint64 arithmetic
+    _M1, _M2, _M4 = np.uint64(0x5555555555555555), np.uint64(0x3333333333333333), np.uint64(0x0F0F0F0F0F0F0F0F)
+    _H01, _S1, _S2, _S4, _S56 = np.uint64(0x0101010101010101), np.uint64(1), np.uint64(2), np.uint64(4), np.uint64(56)
+
+    @njit(nogil=True, cache=True)
+    def _bitset_intersections(query_bits, candidate_bits):
+        """Intersection sizes of every query/candidate bitset pair; releases the GIL so match blocks run in parallel."""
+        out = np.empty((query_bits.shape[0], candidate_bits.shape[0]))
+        for i in range(query_bits.shape[0]):
+            for j in range(candidate_bits.shape[0]):
+                total = np.uint64(0)
+                for k in range(query_bits.shape[1]):
+                    x = query_bits[i, k] & candidate_bits[j, k]
+                    x = x - ((x >> _S1) & _M1)
+                    x = (x & _M2) + ((x >> _S2) & _M2)
+                    x = (x + (x >> _S4)) & _M4
+                    total += (x * _H01) >> _S56
+                out[i, j] = total
+        return out
+else:
+    _bitset_intersections = None
+
+def _field_matrices(patient_profiles, patient_ids):
+    """
+    Builds per-field presence matrices over a per-field vocabulary (shared by the two fusion fields).
+
+    Returns a list of (key, query, candidate) where query/candidate are dicts holding
+      'M': float32 (N, V) presence matrix, or 'bits': uint64 (N, ceil(V/64)) packed bitsets for large fields,
+      'count': (N,) set sizes,
+      'numeric': (N,) bool, 'sum'/'max': (N,) float64 from _numeric_summary.
+    The candidate side of a fusion field is the union of the patient's gene3 and gene5 values.
+    """
+    fields = list(dict.fromkeys(key for pid in patient_ids for key in patient_profiles[pid]))
+    n = len(patient_ids)
+
+    vocabularies = {}
+    for key in fields:
+        vocab = vocabularies.setdefault("fusion" if key in FUSION_PARTNERS else key, {})
+        for pid in patient_ids:
+            for value in patient_profiles[pid].get(key, ()):
+                vocab.setdefault(value, len(vocab))
+
+    def side(key, value_sets):
+        vocab = vocabularies["fusion" if key in FUSION_PARTNERS else key]
+        counts = np.zeros(n)
+        numeric = np.zeros(n, dtype=bool)
+        sums = np.zeros(n)
+        maxes = np.zeros(n)
+        rows, cols = [], []
+        for row, values in enumerate(value_sets):
+            rows.extend([row] * len(values))
+            cols.extend(vocab[value] for value in values)
+            counts[row] = len(values)
+            summary = _numeric_summary(values)
+            if summary is not None:
+                numeric[row] = True
+                sums[row], maxes[row] = summary
+        encoded = {"count": counts, "numeric": numeric, "sum": sums, "max": maxes}
+        rows, cols = np.asarray(rows, dtype=np.intp), np.asarray(cols, dtype=np.intp)
+        # The numba kernel outpaces matmul on sparse sets, so with numba every field is packed
+        if _bitset_intersections is None and n * len(vocab) * 4 <= DENSE_FIELD_MAX_BYTES:
+            encoded["M"] = np.zeros((n, len(vocab)), dtype=np.float32)
+            encoded["M"][rows, cols] = 1
+        else:
+            encoded["bits"] = np.zeros((n, (len(vocab) + 63) // 64), dtype=np.uint64)
+            np.bitwise_or.at(encoded["bits"], (rows, cols >> 6), np.left_shift(np.uint64(1), (cols & 63).astype(np.uint64)))
+        return encoded
+
+    matrices = []
+    for key in fields:
+        query_sets = [set(patient_profiles[pid].get(key, ())) for pid in patient_ids]
+        partner = FUSION_PARTNERS.get(key)
+        if partner is None:
+            query = candidate = side(key, query_sets)
+        else:
+            candidate_sets = [
+                values.union(patient_profiles[pid][partner]) if partner in patient_profiles[pid] else values
+                for pid, values in zip(patient_ids, query_sets)
+            ]
+            query, candidate = side(key, query_sets), side(key, candidate_sets)
+        matrices.append((key, query, candidate))
+    return matrices
+
+def _intersection_counts(query, candidate, rows):
+    """Intersection sizes of the query rows' sets with every candidate set, as a float64 (rows, N) matrix."""
+    if "M" in query:
+        return (query["M"][rows] @ candidate["M"].T).astype(np.float64)
+
+    query_bits, candidate_bits = query["bits"][rows], candidate["bits"]
+    if _bitset_intersections is not None:
+        return _bitset_intersections(query_bits, candidate_bits)
+    intersection = np.empty((len(rows), len(candidate_bits)))
+    step = max(1, BITSET_CHUNK_BYTES // max(1, candidate_bits.nbytes))
+    for start in range(0, len(rows), step):
+        words = query_bits[start:start + step, None, :] & candidate_bits[None, :, :]
+        intersection[start:start + step] = _popcount(words).sum(axis=-1)
+    return intersection
+
+def _field_similarity(query, candidate, rows):
+    """
+    Similarity of the query rows against every candidate for one field, matching jaccard_similarity:
+    the numeric formula where both sets are numeric, Jaccard (intersection / union) otherwise.
+    """
+    intersection = _intersection_counts(query, candidate, rows)
+    union = query["count"][rows, None] + candidate["count"][None, :] - intersection
+    similarity = np.divide(intersection, union, out=np.zeros_like(intersection), where=union != 0)
+
+    both_numeric = query["numeric"][rows, None] & candidate["numeric"][None, :]
+    if both_numeric.any():
+        max_val = np.maximum(query["max"][rows, None], candidate["max"][None, :])
+        numeric = 1 - (np.abs(query["sum"][rows, None] - candidate["sum"][None, :]) / (max_val + 1e-9))
+        similarity = np.where(both_numeric, numeric, similarity)
+    return similarity
+
+def _top_matches(patient_ids, row_scores, top_n):
+    """Top N (patient_id, score) pairs of a score row, descending, ties kept in patient order like a stable sort."""
+    if top_n < len(row_scores):
+        kth = np.partition(row_scores, len(row_scores) - top_n)[len(row_scores) - top_n]
+        candidates = np.flatnonzero(row_scores >= kth)
+    else:
+        candidates = np.arange(len(row_scores))
+    order = candidates[np.argsort(-row_scores[candidates], kind='stable')][:top_n]
+    return [(patient_ids[idx], float(row_scores[idx])) for idx in order]
+
+def _match_block(rows, patient_ids, matrices, weights, max_scores, has_fields, top_n):
+    """Scores one block of query patients against all patients and returns their (patient_id, top matches) pairs."""
+    scores = np.zeros((len(rows), len(patient_ids)))
+    for key, query, candidate in matrices:
+        # Only the query patient's non-empty fields contribute
+        nonempty = query["count"][rows] > 0
+        if nonempty.any():
+            scores[nonempty] += weights.get(key, 1.0) * _field_similarity(query, candidate, rows[nonempty])
+
+    block_matches = []
+    for offset, row in enumerate(rows):
+        patient_id = patient_ids[row]
+        # Only patients with at least one non-empty field (and a positive max score) get matches
+        if not has_fields[row] or max_scores[row] <= 0:
+            block_matches.append((patient_id, []))
+            continue
+        # Normalize the score by dividing by the max score for the patient, leaving the patient itself out
+        row_scores = np.delete(scores[offset] / max_scores[row], row)
+        other_ids = patient_ids[:row] + patient_ids[row + 1:]
+        block_matches.append((patient_id, _top_matches(other_ids, row_scores, top_n)))
+    return block_matches
+
 def calculate_similarity(patient_profiles, top_n, weights):
     # Get patient IDs and their corresponding profiles
     patient_ids = list(patient_profiles.keys())
     matches = {}
 
-    max_scores = {}
-    for patient_id in patient_ids:
-        max_score = 0
-        for key in patient_profiles[patient_id]:
-            set1 = set(patient_profiles[patient_id][key])
-            if set1:  # Calculate self-similarity for non-empty fields
-                weight = weights.get(key, 1.0)
-                max_score += weight * jaccard_similarity(set1, set1)
-        max_scores[patient_id] = max_score
-
-    # Calculate normalized similarity for each patient pair
-    for i, patient_id in enumerate(tqdm(patient_ids, desc='Matching patients')):
-        similarity_scores = []
-        for j, other_patient_id in enumerate(patient_ids):
-            if i != j:
-                score = 0
-                valid_fields = 0  
-                
-                # Calculate similarity for each profile attribute
-                for key in patient_profiles[patient_id]:
-                    set1 = set(patient_profiles[patient_id][key])
-                    set2 = set(patient_profiles[other_patient_id][key])
-
-                    # for fusions
-                    if key == "fusion_gene3" and "fusion_gene5" in patient_profiles[other_patient_id]:
-                        set2_union = set2.union(set(patient_profiles[other_patient_id]["fusion_gene5"]))
-                        if set1:
-                            weight = weights.get(key, 1.0)
-                            score += weight * jaccard_similarity(set1, set2_union)
-                            valid_fields += 1
-                    elif key == "fusion_gene5" and "fusion_gene3" in patient_profiles[other_patient_id]:
-                        set2_union = set2.union(set(patient_profiles[other_patient_id]["fusion_gene3"]))
-                        if set1:
-                            weight = weights.get(key, 1.0)
-                            score += weight * jaccard_similarity(set1, set2_union)
-                            valid_fields += 1
-                    else:
-                        if set1:
-                            weight = weights.get(key, 1.0)
-                            score += weight * jaccard_similarity(set1, set2)
-                            valid_fields += 1
-
-                # Normalize the score by dividing by the max score for the patient
-                if valid_fields > 0 and max_scores[patient_id] > 0:
-                    normalized_score = score / max_scores[patient_id]
-                    similarity_scores.append((other_patient_id, normalized_score))
-
-        # Sort similarity scores in descending order and select top N matches
-        similarity_scores.sort(key=lambda x: x[1], reverse=True)
-        matches[patient_id] = similarity_scores[:top_n]
+    matrices = _field_matrices(patient_profiles, patient_ids)
 
-    return matches
+    # Self-similarity of a non-empty field is always 1, so the max score is the sum of the weights of non-empty fields
+    max_scores = np.zeros(len(patient_ids))
+    has_fields = np.zeros(len(patient_ids), dtype=bool)
+    for key, query, _ in matrices:
+        nonempty = query["count"] > 0
+        max_scores += weights.get(key, 1.0) * nonempty
+        has_fields |= nonempty
 
-def matches_to_dataframe(matches, patient_profiles):
-    # Create a list of rows to store query and similar patient information
-    rows = []
+    # Calculate normalized similarity for blocks of query patients against all patients
+    blocks = [np.arange(start, min(start + SIMILARITY_BLOCK_SIZE, len(patient_ids)))
+              for start in range(0, len(patient_ids), SIMILARITY_BLOCK_SIZE)]
 
-    for query_patient, similar_patients in matches.items():
-        query_data = patient_profiles.get(query_patient, {})
+    def match_block(rows):
+        return _match_block(rows, patient_ids, matrices, weights, max_scores, has_fields, top_n)
 
-        for similar_patient, score in similar_patients:
-            similar_data = patient_profiles.get(similar_patient, {})
+    # No more threads than blocks, so small cohorts do not spin up idle workers
+    with ThreadPoolExecutor(max_workers=max(1, min(TWIN_MATCH_WORKERS, len(blocks)))) as executor:
+        for block_matches in tqdm(executor.map(match_block, blocks), total=len(blocks), desc='Matching patients'):
+            matches.update(block_matches)
 
-            # Flatten query and similar patient profiles into a single dictionary
-            row = {
-                "Query": query_patient.replace(".json", ""),
-                "Similar": similar_patient.replace(".json", ""),
-                "Score": score,
-            }
-            # Add fields from the query patient
-            for field, values in query_data.items():
-                row[f"Query_{field}"] = ", ".join(map(str, values)) if values else ""
+    return matches
 
-            # Add fields from the similar patient
-            for field, values in similar_data.items():
-                row[f"Similar_{field}"] = ", ".join(map(str, values)) if values else ""
+def calculate_single_similarity(patient_profiles, query_id, top_n, weights):
+    """
+    Scores one query patient against every other patient with the same weighting as calculate_similarity,
+    except that every other patient is ranked, with a score of 0 when the query has no non-empty fields.
+    """
+    patient_ids = list(patient_profiles.keys())
+
+    # Profiles flattened to lists indexed by field position; every profile carries the same fields
+    fields = list(patient_profiles[query_id])
+    field_idx = {field: f for f, field in enumerate(fields)}
+    g3, g5 = field_idx.get("fusion_gene3"), field_idx.get("fusion_gene5")
+    fusion_partner = {g3: g5, g5: g3} if g3 is not None and g5 is not None else {}
+    profile_rows = {pid: [profile[field] for field in fields] for pid, profile in patient_profiles.items()}
+
+    # The query's non-empty value sets are invariant across candidates, so they are frozen once
+    query_fields = [(f, frozenset(values)) for f, values in enumerate(profile_rows[query_id]) if values]
+    other_ids = [pid for pid in patient_ids if pid != query_id]
+
+    max_score = 0
+    for f, set1 in query_fields:
+        weight = weights.get(fields[f], 1.0)
+        max_score += weight * jaccard_similarity(set1, set1)
+    if not query_fields or max_score <= 0:
+        # Every candidate scores 0, so the ranking is just patient order
+        return [(other_patient_id, 0) for other_patient_id in other_ids[:top_n]]
+
+    # Field-major: the query set, weight and fusion handling are fixed while scanning the candidates
+    scores = np.zeros(len(other_ids))
+    for f, set1 in query_fields:
+        weight = weights.get(fields[f], 1.0)
+        partner = fusion_partner.get(f)
+        # Whether a set is numeric is decided once per set rather than re-tried for every pair
+        numeric1 = _numeric_summary(set1)
+        for j, other_patient_id in enumerate(other_ids):
+            row = profile_rows[other_patient_id]
+            # for fusions, the candidate's gene3 and gene5 values combined
+            set2 = frozenset(row[f]).union(row[partner]) if partner is not None else frozenset(row[f])
+            numeric2 = _numeric_summary(set2) if numeric1 is not None else None
+            if numeric2 is not None:
+                # Same numeric similarity as jaccard_similarity: 1 - (difference / max)
+                max_val = max(numeric1[1], numeric2[1])
+                similarity = 1 - (abs(numeric1[0] - numeric2[0]) / (max_val + 1e-9))
+            else:
+                # union size is |set1| + |set2| - intersection, without building the union set
+                intersection = len(set1 & set2)
+                union = len(set1) + len(set2) - intersection
+                similarity = intersection / union if union != 0 else 0
+            scores[j] += weight * similarity
 
-            rows.append(row)
+    return _top_matches(other_ids, scores / max_score, top_n)
+
+def matches_to_dataframe(matches, patient_profiles):
+    # Each patient's fields are joined to strings once, since a patient shows up in many rows
+    joined = {}
+    def joined_fields(patient_id):
+        if patient_id not in joined:
+            joined[patient_id] = {
+                field: ", ".join(map(str, values)) if values else ""
+                for field, values in patient_profiles.get(patient_id, {}).items()
+            }
+        return joined[patient_id]
+
+    pairs = [(query_patient, similar_patient, score)
+             for query_patient, similar_patients in matches.items()
+             for similar_patient, score in similar_patients]
+    query_fields = dict.fromkeys(field for query_patient, _, _ in pairs for field in joined_fields(query_patient))
+    similar_fields = dict.fromkeys(field for _, similar_patient, _ in pairs for field in joined_fields(similar_patient))
+
+    # Build the table column by column instead of one dict per row
+    columns = {
+        "Query": [query_patient.replace(".json", "") for query_patient, _, _ in pairs],
+        "Similar": [similar_patient.replace(".json", "") for _, similar_patient, _ in pairs],
+        "Score": [score for _, _, score in pairs],
+    }
+    # Fields from the query patient, then from the similar patient
+    for field in query_fields:
+        columns[f"Query_{field}"] = [joined[query_patient].get(field) for query_patient, _, _ in pairs]
+    for field in similar_fields:
+        columns[f"Similar_{field}"] = [joined[similar_patient].get(field) for _, similar_patient, _ in pairs]
 
-    # Convert the list of rows to a DataFrame
-    df = pd.DataFrame(rows)
+    df = pd.DataFrame(columns)
     return df
 
-def main():
+def write_excel(df, output_filename):
+    """Write a DataFrame to xlsx row by row through a constant-memory xlsxwriter workbook; NaN cells are left blank."""
+    workbook = xlsxwriter.Workbook(output_filename, {'constant_memory': True, 'strings_to_urls': False})
+    try:
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, [str(col) for col in df.columns])
+        # constant_memory only accepts cells in row order, so rows are assembled from Python-native columns
+        columns = [df[col].tolist() for col in df.columns]
+        for row_num, values in enumerate(zip(*columns), start=1):
+            worksheet.write_row(row_num, 0, [None if pd.isna(value) else value for value in values])
+    finally:
+        workbook.close()
+
+def build_parser():
+    """Build the argument parser shared by the CLI and in-process callers."""
     parser = argparse.ArgumentParser(description='Twin matching algorithm with optional single-patient mode')
     parser.add_argument('--input_dir', type=str, required=True, help='Directory containing all input parquet and config files.')
     parser.add_argument('--output_dir', type=str, required=True, help='Directory to save the final output files.')
@@ -185,7 +423,10 @@ def main():
     parser.add_argument('--weights', type=str, help='Path to custom weights.json file.')
     parser.add_argument('--subsets', type=str, help='Path to custom column_subsets.json file.')
     parser.add_argument('--doctor_id', type=int, help='Doctor ID to be included in the output.')
-    args = parser.parse_args()
+    return parser
+
+def run(args):
+    """Run the matching for an already-parsed argument namespace. Exits via sys.exit on failure."""
 
     # --- Load Configuration Files ---
     script_dir = os.path.dirname(os.path.realpath(__file__)) # Get directory of the script
@@ -196,8 +437,8 @@ def main():
 
     
     try:
-        with open(subsets_path, 'r') as f:
-            subsets = json.load(f)
+        with open(subsets_path, 'rb') as f:
+            subsets = orjson.loads(f.read())
             snv_subset = subsets['snv_subset']
             cnv_subset = subsets['cnv_subset']
             fusion_subset = subsets['fusion_subset']
@@ -211,8 +452,8 @@ def main():
 
     default_weights = { "clinical_cancerSite": 0.1, "snv_variantPDot": 2, "snv_Impact": 3, "cnv_geneName": 7.6, "fusion_gene3": 9.25, "snv_geneMarker": 0.0, "snv_geneName": 4, "fusion_gene5": 9.25, "clinical_gender": 0.2, "clinical_morphologyIdcCode": 0.1, "clinical_age": 0.2 }
     try:
-        with open(weights_path, 'r') as f:
-            weights_2 = json.load(f)
+        with open(weights_path, 'rb') as f:
+            weights_2 = orjson.loads(f.read())
     except FileNotFoundError:
         print(f"Warning: Weights file not found at '{weights_path}'. Using default weights.")
         weights_2 = default_weights
@@ -274,57 +515,24 @@ def main():
 
     # --- Main Logic ---
     profiles_path = os.path.join(args.input_dir, "patient_profiles")
-    patient_profiles = create_patient_profiles(snv_df, cnv_df, fusion_df, clinical_df, snv_subset, cnv_subset, fusion_subset, clinical_subset, profiles_path)
+    patient_profiles = create_patient_profiles(snv_df, cnv_df, fusion_df, clinical_df, snv_subset, cnv_subset, fusion_subset, clinical_subset)
 
+    # The profile files are only a by-product, so they are written while the matching runs
+    with ThreadPoolExecutor(max_workers=1) as profile_writer:
+        profiles_saved = profile_writer.submit(save_patient_profiles, patient_profiles, profiles_path)
+        write_matches(args, patient_profiles, weights_2)
+        profiles_saved.result()
+
+def write_matches(args, patient_profiles, weights):
+    """Match the in-memory profiles (one patient with --single, otherwise all) and write the output files."""
     if args.single:
         # Only calculate matches for the specified patient
         query_id = args.single
         if query_id not in patient_profiles:
             print(f"Patient ID {query_id} not found in profiles.")
-            exit(1)
+            sys.exit(1)
         # Calculate similarity only for this patient
-        matches = {}
-        patient_ids = list(patient_profiles.keys())
-        max_score = 0
-        for key in patient_profiles[query_id]:
-            set1 = set(patient_profiles[query_id][key])
-            if set1:
-                weight = weights_2.get(key, 1.0)
-                max_score += weight * jaccard_similarity(set1, set1)
-        similarity_scores = []
-        for other_patient_id in patient_ids:
-            if other_patient_id == query_id:
-                continue
-            score = 0
-            valid_fields = 0
-            for key in patient_profiles[query_id]:
-                set1 = set(patient_profiles[query_id][key])
-                set2 = set(patient_profiles[other_patient_id][key])
-                # for fusions
-                if key == "fusion_gene3" and "fusion_gene5" in patient_profiles[other_patient_id]:
-                    set2_union = set2.union(set(patient_profiles[other_patient_id]["fusion_gene5"]))
-                    if set1:
-                        weight = weights_2.get(key, 1.0)
-                        score += weight * jaccard_similarity(set1, set2_union)
-                        valid_fields += 1
-                elif key == "fusion_gene5" and "fusion_gene3" in patient_profiles[other_patient_id]:
-                    set2_union = set2.union(set(patient_profiles[other_patient_id]["fusion_gene3"]))
-                    if set1:
-                        weight = weights_2.get(key, 1.0)
-                        score += weight * jaccard_similarity(set1, set2_union)
-                        valid_fields += 1
-                else:
-                    if set1:
-                        weight = weights_2.get(key, 1.0)
-                        score += weight * jaccard_similarity(set1, set2)
-                        valid_fields += 1
-            if valid_fields > 0 and max_score > 0:
-                normalized_score = score / max_score
-            else:
-                normalized_score = 0
-            similarity_scores.append((other_patient_id, normalized_score))
-        similarity_scores.sort(key=lambda x: x[1], reverse=True)
-        top_matches = similarity_scores[:20]
+        top_matches = calculate_single_similarity(patient_profiles, query_id, top_n=20, weights=weights)
         # Output as DataFrame
         matches = {query_id: top_matches}
         match_df = matches_to_dataframe(matches, patient_profiles)
@@ -350,18 +558,18 @@ def main():
                     match_info['doctor_id'] = record['doctor_id']
                 json_results["matches"].append(match_info)
             output_filename = os.path.join(args.output_dir, f"matches_{query_id}.json")
-            with open(output_filename, 'w') as f:
-                json.dump(json_results, f, indent=4)
+            with open(output_filename, 'wb') as f:
+                f.write(orjson.dumps(json_results, option=JSON_DUMP_OPTIONS))
             print(f"Output for patient {query_id} saved to {output_filename}")
         else:
             output_filename = os.path.join(args.output_dir, f"matches_scoring_{query_id}.xlsx")
-            match_df.to_excel(output_filename, index=False)
+            write_excel(match_df, output_filename)
             print(f"Output for patient {query_id} saved to {output_filename}")
-        exit(0)
+        return
 
-    patient_ids = os.listdir(profiles_path)
-    profiles = {patient_id: json.load(open(os.path.join(profiles_path, patient_id))) for patient_id in patient_ids}
-    matches = calculate_similarity(profiles, top_n=20, weights=weights_2)
+    # Patient IDs as strings, as they were when profiles were read back from their files
+    profiles = {str(patient_id): profile for patient_id, profile in patient_profiles.items()}
+    matches = calculate_similarity(profiles, top_n=20, weights=weights)
     match_df = matches_to_dataframe(matches, profiles)
 
     print(match_df.columns)
@@ -398,9 +606,10 @@ def main():
     match_df['c_match'] = match_df['Query_clinical_cancerSite'] == match_df['Similar_clinical_cancerSite']
     match_df['cancer_match'] = np.where(match_df['c_match'], "same", "other")
 
-    output_filename = os.path.join(args.output_dir, "matches_scoring_consolidated.xlsx")
-    match_df.to_excel(output_filename, index=False)
-    print(f"Consolidated Excel matches saved to {output_filename}")
+    # Parquet copy for downstream merges, which is much cheaper to read back than xlsx
+    output_filename = os.path.join(args.output_dir, "matches_scoring_consolidated.parquet")
+    match_df.to_parquet(output_filename, index=False)
+    print(f"Consolidated Parquet matches saved to {output_filename}")
 
     if args.json_output:
         # Save consolidated results as JSON with minimal structure
@@ -417,17 +626,20 @@ def main():
                 match_info['doctor_id'] = record['doctor_id']
             json_results["matches"].append(match_info)
         output_filename = os.path.join(args.output_dir, "matches_consolidated.json")
-        with open(output_filename, 'w') as f:
-            json.dump(json_results, f, indent=4)
+        with open(output_filename, 'wb') as f:
+            f.write(orjson.dumps(json_results, option=JSON_DUMP_OPTIONS))
         print(f"Consolidated JSON matches saved to {output_filename}")
     else:
         output_filename = os.path.join(args.output_dir, "matches_scoring_consolidated.xlsx")
-        match_df.to_excel(output_filename, index=False)
+        write_excel(match_df, output_filename)
         print(f"Consolidated Excel matches saved to {output_filename}")
 
 
+def main():
+    run(build_parser().parse_args())
+
+
 if __name__ == "__main__":
-    import sys
     main()
 
 
@@ -1,19 +1,27 @@
-import requests
-import json
-import pandas as pd
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import httpx
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
+import sys
 import argparse
 from dotenv import load_dotenv
 
 load_dotenv(override=True)
 
-def get_auth_token(session, email, password):
+# Chunk requests kept in flight against the CDSS API at once
+CDSS_FETCH_CONCURRENCY = 10
+# Compression for the genomic Parquet files; zstd at a low level is smaller than snappy at similar speed
+PARQUET_COMPRESSION = 'zstd'
+PARQUET_COMPRESSION_LEVEL = 3
+
+async def get_auth_token(client, email, password):
     """
-    Authenticates with the API using a session object to retrieve a token.
+    Authenticates with the API using a shared async client to retrieve a token.
 
     Args:
-        session (requests.Session): The session object for making HTTP requests.
+        client (httpx.AsyncClient): The client used for making HTTP requests.
         email (str): The user's email address for authentication.
         password (str): The user's password for authentication.
 
@@ -24,25 +32,25 @@ def get_auth_token(session, email, password):
     login_payload = {"email": email, "password": password}
 
     try:
-        with session.post(f'{login_url}/user/login', json=login_payload, timeout=10) as response:
-            response.raise_for_status()
-            response_data = response.json()
-            if response_data.get("success"):
-                print("Authentication successful.")
-                return response_data.get("payLoad", {}).get("authToken")
-            else:
-                print(f"Authentication failed: {response_data.get('message')}")
-                return None
-    except requests.exceptions.RequestException as e:
+        response = await client.post(f'{login_url}/user/login', json=login_payload, timeout=10)
+        response.raise_for_status()
+        response_data = orjson.loads(response.content)
+        if response_data.get("success"):
+            print("Authentication successful.")
+            return response_data.get("payLoad", {}).get("authToken")
+        else:
+            print(f"Authentication failed: {response_data.get('message')}")
+            return None
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
         print(f"An error occurred during authentication: {e}")
         return None
 
-def get_cdss_data_chunk(session, auth_token, patient_ids_chunk):
+async def get_cdss_data_chunk(client, auth_token, patient_ids_chunk):
     """
     Fetches CDSS data for a single chunk of patient IDs.
 
     Args:
-        session (requests.Session): The session object for making HTTP requests.
+        client (httpx.AsyncClient): The client used for making HTTP requests.
         auth_token (str): The authentication token.
         patient_ids_chunk (list): A list (chunk) of patient ECRF IDs.
 
@@ -53,18 +61,44 @@ def get_cdss_data_chunk(session, auth_token, patient_ids_chunk):
     headers = {'Authorization': f'Bearer {auth_token}'}
 
     try:
-        with session.post(cdss_url, headers=headers, json=patient_ids_chunk, timeout=1200) as response:
-            response.raise_for_status()
-            response_data = response.json()
-            if response_data.get("success"):
-                return response_data.get("payLoad", [])
-            else:
-                print(f"Failed to fetch data for chunk. Message: {response_data.get('message')}")
-                return None
-    except requests.exceptions.RequestException as e:
+        response = await client.post(cdss_url, headers=headers, json=patient_ids_chunk, timeout=1200)
+        response.raise_for_status()
+        response_data = orjson.loads(response.content)
+        if response_data.get("success"):
+            return response_data.get("payLoad", [])
+        else:
+            print(f"Failed to fetch data for chunk. Message: {response_data.get('message')}")
+            return None
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
         print(f"An error occurred while fetching a CDSS data chunk: {e}")
         return None
 
+# Placeholder for a key absent from a record, which pandas would have filled with NaN
+MISSING = object()
+
+def append_record(columns, record):
+    """
+    Appends one record to column-wise lists, like a pd.DataFrame row: a key first seen here gets a new column
+    back-filled with missing values, and columns absent from the record get a missing value.
+    """
+    n_rows = len(next(iter(columns.values()))) if columns else 0
+    for key in record:
+        if key not in columns:
+            columns[key] = [MISSING] * n_rows
+    for key, values in columns.items():
+        values.append(record.get(key, MISSING))
+
+def column_as_str(values):
+    """Stringifies a column the way Series.astype(str) does for object columns: absent values become 'nan'."""
+    return ['nan' if value is MISSING else str(value) for value in values]
+
+def write_parquet(columns, path):
+    """Writes column-wise lists to a zstd-compressed Parquet file; absent values are stored as nulls."""
+    table = pa.table({name: pa.array([None if value is MISSING else value for value in values])
+                      for name, values in columns.items()})
+    pq.write_table(table, path, compression=PARQUET_COMPRESSION, compression_level=PARQUET_COMPRESSION_LEVEL)
+    return table.num_rows
+
 def parse_to_parquet_and_save_ids(data, output_dir):
     """
     Parses the complex JSON response and saves SNV, CNA, and Fusion data into separate Parquet files
@@ -74,7 +108,7 @@ def parse_to_parquet_and_save_ids(data, output_dir):
         data (list): The list of patient data from the API response.
         output_dir (str): The directory to save the Parquet files and retrieved IDs list.
     """
-    snv_rows, cna_rows, fusion_rows = [], [], []
+    snv_cols, cna_cols, fusion_cols = {}, {}, {}
     retrieved_ids = set()
 
     for patient in data:
@@ -82,11 +116,11 @@ def parse_to_parquet_and_save_ids(data, output_dir):
         if patient_id:
             retrieved_ids.add(patient_id)
         for snv in patient.get('snvDataList', []):
-            snv_rows.append({'patientID': patient_id, **snv})
+            append_record(snv_cols, {'patientID': patient_id, **snv})
         for cna in patient.get('cnaDataList', []):
-            cna_rows.append({'patientID': patient_id, **cna})
+            append_record(cna_cols, {'patientID': patient_id, **cna})
         for fusion in patient.get('fusionDataList', []):
-            fusion_rows.append({'patientID': patient_id, **fusion})
+            append_record(fusion_cols, {'patientID': patient_id, **fusion})
 
     # Ensure output directory exists
     os.makedirs(output_dir, exist_ok=True)
@@ -94,37 +128,36 @@ def parse_to_parquet_and_save_ids(data, output_dir):
     try:
         files_created = []
         
-        if snv_rows:
-            snv_df = pd.DataFrame(snv_rows)
+        if snv_cols:
             # Create the "Impact" column as concatenation of geneName and clinicalSignificanceOfTheVariant
-            if 'geneName' in snv_df.columns and 'clinicalSignificanceOfTheVariant' in snv_df.columns:
-                snv_df['Impact'] = snv_df['geneName'].astype(str) + "_" + snv_df['clinicalSignificanceOfTheVariant'].astype(str)
+            if 'geneName' in snv_cols and 'clinicalSignificanceOfTheVariant' in snv_cols:
+                snv_cols['Impact'] = [f"{gene}_{significance}" for gene, significance in zip(
+                    column_as_str(snv_cols['geneName']), column_as_str(snv_cols['clinicalSignificanceOfTheVariant']))]
             else:
-                snv_df['Impact'] = ""
+                snv_cols['Impact'] = [""] * len(snv_cols['patientID'])
             snv_file = os.path.join(output_dir, 'snv_cdss_input.parquet')
-            snv_df.to_parquet(snv_file, index=False)
+            n_records = write_parquet(snv_cols, snv_file)
             files_created.append(snv_file)
-            print(f"Created SNV file with {len(snv_df)} records")
+            print(f"Created SNV file with {n_records} records")
         else:
             print("Warning: No SNV data found")
             
-        if cna_rows:
-            cna_df = pd.DataFrame(cna_rows)
-            cna_df['Impact'] = cna_df['geneName'].astype(str) + "_" + cna_df['clinicalSignificanceOfTheVariant'].astype(str)
+        if cna_cols:
+            cna_cols['Impact'] = [f"{gene}_{significance}" for gene, significance in zip(
+                column_as_str(cna_cols['geneName']), column_as_str(cna_cols['clinicalSignificanceOfTheVariant']))]
             cna_file = os.path.join(output_dir, 'cnv_cdss_input.parquet')
-            cna_df.to_parquet(cna_file, index=False)
+            n_records = write_parquet(cna_cols, cna_file)
             files_created.append(cna_file)
-            print(f"Created CNA file with {len(cna_df)} records")
+            print(f"Created CNA file with {n_records} records")
         else:
             print("Warning: No CNA data found")
             
-        if fusion_rows:
-            fusion_df = pd.DataFrame(fusion_rows)
-            fusion_df['Impact'] = fusion_df['clinicalSignificanceOfTheVariant'].astype(str)
+        if fusion_cols:
+            fusion_cols['Impact'] = column_as_str(fusion_cols['clinicalSignificanceOfTheVariant'])
             fusion_file = os.path.join(output_dir, 'fusion_cdss_input.parquet')
-            fusion_df.to_parquet(fusion_file, index=False)
+            n_records = write_parquet(fusion_cols, fusion_file)
             files_created.append(fusion_file)
-            print(f"Created Fusion file with {len(fusion_df)} records")
+            print(f"Created Fusion file with {n_records} records")
         else:
             print("Warning: No Fusion data found")
 
@@ -169,17 +202,48 @@ def load_ids_from_file(filename="samples.txt"):
         print("Please create this file in the same directory as the script, with one sample ID per line.")
         return []
 
-if __name__ == "__main__":
-    load_dotenv() # Load environment variables from .env file
+async def fetch_cdss_data(email, password, ecrf_ids, chunk_size=200):
+    """
+    Authenticates and fetches CDSS data for all IDs, with the chunk requests issued concurrently on one client.
 
-    # --- Argument Parsing ---
+    Returns:
+        list: The combined patient data (in chunk order), or None if authentication failed.
+    """
+    limits = httpx.Limits(max_connections=CDSS_FETCH_CONCURRENCY, max_keepalive_connections=CDSS_FETCH_CONCURRENCY)
+    async with httpx.AsyncClient(limits=limits) as client:
+        print("Attempting to authenticate...")
+        token = await get_auth_token(client, email, password)
+        if not token:
+            return None
+
+        print("Fetching CDSS data concurrently...")
+        id_chunks = [ecrf_ids[i:i + chunk_size] for i in range(0, len(ecrf_ids), chunk_size)]
+        # Chunks queue on the semaphore rather than in the connection pool, whose wait counts against the timeout
+        semaphore = asyncio.Semaphore(CDSS_FETCH_CONCURRENCY)
+
+        async def fetch_chunk(chunk):
+            async with semaphore:
+                return await get_cdss_data_chunk(client, token, chunk)
+
+        results = await asyncio.gather(*(fetch_chunk(chunk) for chunk in id_chunks))
+
+    all_patient_data = []
+    for result in results:
+        if result:
+            all_patient_data.extend(result)
+    return all_patient_data
+
+def build_parser():
+    """Build the argument parser shared by the CLI and in-process callers."""
     parser = argparse.ArgumentParser(description='Retrieve genomic data from CDSS API')
     parser.add_argument('--samples', type=str, required=True,
                        help='Path to samples file containing patient IDs.')
     parser.add_argument('--output_dir', type=str, default='genomic_data_parquet',
                        help='Directory to save the output Parquet files (default: genomic_data_parquet)')
-    args = parser.parse_args()
+    return parser
 
+def run(args):
+    """Retrieve genomic data for an already-parsed argument namespace. Exits via sys.exit on failure."""
     # --- Configuration ---
     user_email = os.getenv("USER_EMAIL")
     user_password = os.getenv("USER_PASSWORD")
@@ -193,49 +257,37 @@ if __name__ == "__main__":
     # Proceed only if IDs were successfully loaded from the file
     if ecrf_ids:
         # --- Main Execution ---
-        all_patient_data = []
-        with requests.Session() as session:
-            print("Attempting to authenticate...")
-            token = get_auth_token(session, user_email, user_password)
-
-            if token:
-                print("Fetching CDSS data concurrently...")
-                # Chunk the patient IDs into lists of 500 (API limit)
-                chunk_size = 200
-                id_chunks = [ecrf_ids[i:i + chunk_size] for i in range(0, len(ecrf_ids), chunk_size)]
-
-                with ThreadPoolExecutor(max_workers=10) as executor:
-                    # Submit all chunks to the executor
-                    future_to_chunk = {executor.submit(get_cdss_data_chunk, session, token, chunk): chunk for chunk in id_chunks}
-
-                    for future in as_completed(future_to_chunk):
-                        result = future.result()
-                        if result:
-                            all_patient_data.extend(result)
-
-                if all_patient_data:
-                    print(f"\nSuccessfully fetched data for {len(all_patient_data)} records.")
-                    parse_to_parquet_and_save_ids(all_patient_data, output_directory)
-                    
-                    # Verify that critical files were created in the specified output directory
-                    retrieved_list_path = os.path.join(output_directory, 'retrieved_list.txt')
-                    if not os.path.exists(retrieved_list_path):
-                        print(f"\nERROR: Critical file {retrieved_list_path} was not created!")
-                        exit(1)
-                    else:
-                        print(f"\nGenomic data retrieval completed successfully.")
-                        print(f"Critical file {retrieved_list_path} confirmed to exist.")
-                else:
-                    print("\nNo data was fetched from the CDSS API.")
-                    print("This could be due to:")
-                    print("- Invalid patient IDs in the samples file")
-                    print("- Network connectivity issues")
-                    print("- API authentication problems")
-                    print("- API server issues")
-                    exit(1)
+        # Chunk the patient IDs into lists of 200 (API limit)
+        all_patient_data = asyncio.run(fetch_cdss_data(user_email, user_password, ecrf_ids, chunk_size=200))
+
+        if all_patient_data is None:
+            print("\nCould not retrieve authentication token. Exiting.")
+            sys.exit(1)
+
+        if all_patient_data:
+            print(f"\nSuccessfully fetched data for {len(all_patient_data)} records.")
+            parse_to_parquet_and_save_ids(all_patient_data, output_directory)
+            
+            # Verify that critical files were created in the specified output directory
+            retrieved_list_path = os.path.join(output_directory, 'retrieved_list.txt')
+            if not os.path.exists(retrieved_list_path):
+                print(f"\nERROR: Critical file {retrieved_list_path} was not created!")
+                sys.exit(1)
             else:
-                print("\nCould not retrieve authentication token. Exiting.")
-                exit(1)
+                print(f"\nGenomic data retrieval completed successfully.")
+                print(f"Critical file {retrieved_list_path} confirmed to exist.")
+        else:
+            print("\nNo data was fetched from the CDSS API.")
+            print("This could be due to:")
+            print("- Invalid patient IDs in the samples file")
+            print("- Network connectivity issues")
+            print("- API authentication problems")
+            print("- API server issues")
+            sys.exit(1)
     else:
         print("No sample IDs loaded. Exiting.")
-        exit(1)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    load_dotenv() # Load environment variables from .env file
+    run(build_parser().parse_args())